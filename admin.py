@@ -13,10 +13,16 @@
 # limitations under the License.
 
 # [START app]
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from google.appengine.api import users
+from google.appengine.ext import deferred
 from models import User
-from tasks import create_dataset, create_click_log_data
+from tasks import create_dataset, create_click_log_data, backfill_redirects, provision_click_log_tables, \
+    backfill_long_url_index, reindex_short_urls, rebuild_tag_summaries, backfill_api_tokens
+from cache import cache_stats, rebuild_path_filters
+from ingestion import flush_clicks
+from rollups import backfill_click_rollups
+from ogp import ogp_cache_stats
 
 app = Flask(__name__)
 
@@ -27,6 +33,12 @@ def create_bq():
     return result, 200
 
 
+@app.route('/_admin/provisionbq', methods=['GET'])
+def provision_bq():
+    result = provision_click_log_tables()
+    return result, 200
+
+
 @app.route('/_admin/createtestdata', methods=['GET'])
 def create_test_data():
     team_id = request.cookies.get('team', False)
@@ -36,4 +48,57 @@ def create_test_data():
     return result, 200
 
 
+@app.route('/_admin/rebuildpathfilter/<domain>', methods=['GET'])
+def rebuild_path_filter(domain):
+    deferred.defer(rebuild_path_filters, domain)
+    return 'path filter rebuild started: {}'.format(domain), 200
+
+
+@app.route('/_admin/backfillredirects', methods=['GET'])
+def backfill_redirect():
+    deferred.defer(backfill_redirects)
+    return 'redirect backfill started', 200
+
+
+@app.route('/_admin/backfilllongurlindex', methods=['GET'])
+def backfill_long_url_indexes():
+    deferred.defer(backfill_long_url_index)
+    return 'long url index backfill started', 200
+
+
+@app.route('/_admin/reindexsearch', methods=['GET'])
+def reindex_search():
+    deferred.defer(reindex_short_urls)
+    return 'search reindex started', 200
+
+
+@app.route('/_admin/rebuildtagsummaries', methods=['GET'])
+def rebuild_tag_summary():
+    deferred.defer(rebuild_tag_summaries)
+    return 'tag summary rebuild started', 200
+
+
+@app.route('/_admin/backfillapitokens', methods=['GET'])
+def backfill_api_token():
+    deferred.defer(backfill_api_tokens)
+    return 'api token backfill started', 200
+
+
+@app.route('/_admin/backfillrollups', methods=['GET'])
+def backfill_rollup():
+    deferred.defer(backfill_click_rollups)
+    return 'click rollup backfill started', 200
+
+
+@app.route('/_admin/clicks/flush', methods=['POST'])
+def flush_click():
+    result = flush_clicks()
+    return '{} clicks flushed'.format(result), 200
+
+
+@app.route('/_admin/stats/cache', methods=['GET'])
+def stats_cache():
+    return jsonify(dict(cache_stats(), ogp=ogp_cache_stats()))
+
+
 # [END app]
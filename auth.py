@@ -0,0 +1,130 @@
+import hashlib
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from cache import LRUCache, count, INVALIDATION_LOCK_SECONDS
+from models import User, APIToken
+
+TEAM_USER_MEMCACHE_KEY = 'validation-{}'
+# other instances drop a disabled user after this many seconds at the latest
+TEAM_USER_LOCAL_TTL = 30
+TEAM_USER_LOCAL_SIZE = 10000
+TOKEN_MEMCACHE_KEY = 'api-token-{}'
+TOKEN_MEMCACHE_TTL = 60 * 60
+TOKEN_MISSING_MEMCACHE_KEY = 'api-token-missing-{}'
+# unknown tokens are not looked up in the datastore again for this many seconds
+TOKEN_MISSING_MEMCACHE_TTL = 60
+# revoked tokens keep working on other instances for this many seconds at the latest
+TOKEN_LOCAL_TTL = 30
+TOKEN_LOCAL_SIZE = 1000
+# uuid4 hex, hashed key names are 64 characters
+LEGACY_TOKEN_LENGTH = 32
+NEW_TOKEN_MEMCACHE_KEY = 'new-token-{}'
+NEW_TOKEN_MEMCACHE_TTL = 60
+
+team_user_cache = LRUCache('team_user', max_size=TEAM_USER_LOCAL_SIZE, ttl=TEAM_USER_LOCAL_TTL)
+token_cache = LRUCache('token', max_size=TOKEN_LOCAL_SIZE, ttl=TOKEN_LOCAL_TTL)
+
+
+def validate_team_user(team_id, user_id):  # type(str, str) -> str
+    """
+    team name when the user is an active member of the team, '' otherwise
+    process-local TTL cache -> memcache -> datastore, failed validations are not cached
+    """
+    team_user_id = "{}_{}".format(team_id, user_id)
+    team_name = team_user_cache.get(team_user_id)
+    if team_name:
+        return team_name
+    memcache_key = TEAM_USER_MEMCACHE_KEY.format(team_user_id)
+    team_name = memcache.get(memcache_key)
+    if team_name:
+        count('team_user.memcache_hits')
+        team_user_cache.set(team_user_id, team_name)
+        return team_name
+    count('team_user.datastore_lookups')
+    team_user = User.get_by_id(team_user_id)
+    team = team_user.team.get() if team_user and team_user.in_use is True else None
+    if team is not None:
+        team_name = team.team_name
+        memcache.add(memcache_key, team_name)
+        team_user_cache.set(team_user_id, team_name)
+        return team_name
+    logging.info('validation failed: team_id = {}, user_id = {}'.format(team_id, user_id))
+    return ''
+
+
+def invalidate_team_user(team_user_id):  # type: (str) -> None
+    team_user_cache.delete(team_user_id)
+    memcache.delete(TEAM_USER_MEMCACHE_KEY.format(team_user_id), seconds=INVALIDATION_LOCK_SECONDS)
+
+
+def hash_token(token):  # type: (str) -> str
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def resolve_token(token):  # type: (str) -> tuple
+    """
+    (team id, user id, revoked) of the API token, None when it does not exist
+    process-local TTL cache -> memcache (positive and negative) -> datastore, tokens are only stored hashed
+    """
+    if not isinstance(token, basestring) or not token:
+        return None
+    token_id = hash_token(token)
+    resolved = token_cache.get(token_id)
+    if resolved is not None:
+        return resolved
+    memcache_key = TOKEN_MEMCACHE_KEY.format(token_id)
+    missing_key = TOKEN_MISSING_MEMCACHE_KEY.format(token_id)
+    cached = memcache.get_multi([memcache_key, missing_key])
+    if memcache_key in cached:
+        count('token.memcache_hits')
+        resolved = cached[memcache_key]
+        token_cache.set(token_id, resolved)
+        return resolved
+    if missing_key in cached:
+        count('token.negative_hits')
+        return None
+    count('token.datastore_lookups')
+    api_token = APIToken.get_by_id(token_id)
+    if api_token is None and len(token) == LEGACY_TOKEN_LENGTH and APIToken.get_by_id(token) is not None:
+        api_token = migrate_legacy_token(token)
+        if api_token is None:
+            # migrated by a concurrent request, the context cache still holds the missing hashed key
+            api_token = APIToken.get_by_id(token_id, use_cache=False)
+    if api_token is None:
+        memcache.add(missing_key, True, time=TOKEN_MISSING_MEMCACHE_TTL)
+        return None
+    resolved = (api_token.team.id(), api_token.created_by.id().split('_')[-1], api_token.revoked is True)
+    memcache.add(memcache_key, resolved, time=TOKEN_MEMCACHE_TTL)
+    token_cache.set(token_id, resolved)
+    return resolved
+
+
+@ndb.transactional(xg=True)
+def migrate_legacy_token(token):  # type: (str) -> APIToken
+    """
+    tokens created before hashing are keyed by the raw token, re-key them by the hash on first use or by backfill
+    """
+    legacy = APIToken.get_by_id(token)
+    if legacy is None:
+        return None
+    api_token = APIToken(id=hash_token(token), team=legacy.team, created_by=legacy.created_by,
+                         description=legacy.description, revoked=legacy.revoked, hint=token[-4:],
+                         created_at=legacy.created_at)
+    api_token.put()
+    legacy.key.delete()
+    return api_token
+
+
+def invalidate_token(token_id):  # type: (str) -> None
+    """
+    token_id is the key name of APIToken, the raw token for tokens generated before hashing
+    """
+    if len(token_id) == LEGACY_TOKEN_LENGTH:
+        token_id = hash_token(token_id)
+    token_cache.delete(token_id)
+    memcache.delete(TOKEN_MEMCACHE_KEY.format(token_id), seconds=INVALIDATION_LOCK_SECONDS)
@@ -0,0 +1,46 @@
+import hashlib
+import struct
+
+
+class CountingBloomFilter(object):
+    """
+    bloom filter with one byte counter per slot, so that members can also be removed
+    saturated counters (255) are never decremented, they only cost false positives
+    """
+
+    def __init__(self, size=65536, hash_count=4, counters=None):
+        self.size = size
+        self.hash_count = hash_count
+        self.counters = bytearray(counters) if counters is not None else bytearray(size)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            if self.counters[position] < 255:
+                self.counters[position] += 1
+
+    def remove(self, item):
+        if item not in self:
+            return
+        for position in self._positions(item):
+            if 0 < self.counters[position] < 255:
+                self.counters[position] -= 1
+
+    def merge(self, other):
+        """
+        keep the larger counter of each slot, members of either filter stay members
+        """
+        for position in range(self.size):
+            if other.counters[position] > self.counters[position]:
+                self.counters[position] = other.counters[position]
+
+    def __contains__(self, item):
+        return all(self.counters[position] for position in self._positions(item))
+
+    def to_bytes(self):
+        return bytes(self.counters)
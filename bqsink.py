@@ -0,0 +1,127 @@
+import time
+import logging
+import threading
+
+BQ_BATCH_SIZE = 500
+BQ_BATCH_MAX_AGE = 10
+BQ_MAX_RETRIES = 3
+BQ_RETRY_BACKOFF = 0.5
+
+
+class BigQuerySink(object):
+    """
+    collects rows per table and streams them with push_rows, keeping one authenticated client per instance
+    rows are flushed when batch_size rows are pending or the oldest row is older than max_age seconds,
+    failed batches are retried with the same insert ids, so BigQuery drops the rows already inserted
+    """
+
+    def __init__(self, client_factory, dataset, ensure_table=None, failure_handler=None, insert_id_key='id',
+                 batch_size=BQ_BATCH_SIZE, max_age=BQ_BATCH_MAX_AGE, max_retries=BQ_MAX_RETRIES):
+        self.client_factory = client_factory
+        self.dataset = dataset
+        self.ensure_table = ensure_table
+        self.failure_handler = failure_handler
+        self.insert_id_key = insert_id_key
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self._client = None
+        self._rows = {}
+        self._pending = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self.client_factory()
+            return self._client
+
+    def reset_client(self, client=None):
+        with self._lock:
+            self._client = client
+
+    def add(self, table_name, row):
+        with self._lock:
+            self._rows.setdefault(table_name, []).append(row)
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            due = self._pending >= self.batch_size or time.time() - self._oldest >= self.max_age
+        if due:
+            self.flush()
+
+    def flush(self):  # type: () -> int
+        with self._lock:
+            rows_by_table, self._rows = self._rows, {}
+            self._pending = 0
+            self._oldest = None
+        pushed = 0
+        for table_name, rows in rows_by_table.items():
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                if self.push(table_name, batch):
+                    pushed += len(batch)
+                elif self.failure_handler is not None:
+                    self.failure_handler(table_name, batch)
+                else:
+                    logging.error('{} rows dropped for {}'.format(len(batch), table_name))
+        return pushed
+
+    def push(self, table_name, rows):  # type: (str, list) -> bool
+        client = self.client
+        if self.ensure_table is not None:
+            self.ensure_table(client, table_name)
+        for attempt in range(self.max_retries):
+            try:
+                if client.push_rows(self.dataset, table_name, rows, self.insert_id_key):
+                    return True
+                logging.warning('push_rows failed: {}, attempt {}'.format(table_name, attempt + 1))
+            except Exception:
+                logging.exception('push_rows failed: {}, attempt {}'.format(table_name, attempt + 1))
+            if attempt + 1 < self.max_retries:
+                time.sleep(BQ_RETRY_BACKOFF * 2 ** attempt)
+        return False
+
+
+class FakeBigQueryClient(object):
+    """
+    offline stand-in of the BigQuery-Python client, push_rows fails fail_times times before it succeeds
+    """
+
+    def __init__(self, fail_times=0):
+        self.datasets = set()
+        self.tables = {}
+        self.fail_times = fail_times
+        self.push_calls = 0
+
+    def check_dataset(self, dataset):
+        return dataset in self.datasets
+
+    def create_dataset(self, dataset, friendly_name=None, description=None):
+        self.datasets.add(dataset)
+        return True
+
+    def check_table(self, dataset, table):
+        return (dataset, table) in self.tables
+
+    def create_table(self, dataset, table, schema):
+        self.tables[(dataset, table)] = []
+        return True
+
+    def push_rows(self, dataset, table, rows, insert_id_key=None):
+        self.push_calls += 1
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            return False
+        stored = self.tables[(dataset, table)]
+        if insert_id_key is None:
+            stored.extend(rows)
+            return True
+        inserted = set(r[insert_id_key] for r in stored)
+        for row in rows:
+            if row[insert_id_key] not in inserted:
+                inserted.add(row[insert_id_key])
+                stored.append(row)
+        return True
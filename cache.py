@@ -0,0 +1,362 @@
+import json
+import time
+import uuid
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache, datastore_errors, taskqueue
+from google.appengine.ext import ndb, deferred
+
+from bloomfilter import CountingBloomFilter
+from models import ShortURL, Redirect, PathFilter
+
+SHORT_URL_MEMCACHE_KEY = 'short-url-{}'
+SHORT_URL_MEMCACHE_TTL = 60 * 60 * 24
+# entries of other instances are not invalidated, so keep the process-local tier short lived
+SHORT_URL_LOCAL_TTL = 60
+SHORT_URL_LOCAL_SIZE = 10000
+# while an invalidated memcache key is locked, memcache.add from readers holding stale data fails
+INVALIDATION_LOCK_SECONDS = 5
+MISSING_MEMCACHE_KEY = 'short-url-missing-{}'
+MISSING_MEMCACHE_TTL = 60
+PATH_FILTER_VERSION_KEY = 'path-filter-version-{}'
+# bounds how long an instance may trust its filter copy if a writer failed to publish a new version
+PATH_FILTER_VERSION_TTL = 60 * 10
+PATH_FILTER_SHARDS = 16
+PATH_FILTER_SIZE = 65536
+PATH_FILTER_HASH_COUNT = 4
+# changes of the path filter are queued by requests and applied in one transaction per shard and interval
+PATH_FILTER_QUEUE_NAME = 'path-filter'
+PATH_FILTER_FLUSH_INTERVAL = 10
+PATH_FILTER_LEASE_SECONDS = 60
+# lease_tasks returns up to 1000 tasks
+PATH_FILTER_LEASE_SIZE = 1000
+SHORT_URLS_VERSION_KEY = 'short-urls-version-{}'
+CLICK_COUNTS_VERSION_KEY = 'click-counts-version-{}'
+
+_caches = {}
+_counters = {}
+
+
+class LRUCache(object):
+    """
+    bounded process-local LRU cache
+    entries expire ttl seconds after they are set, ttl=None keeps them until evicted
+    """
+
+    def __init__(self, name, max_size=1000, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': size,
+                'max_size': self.max_size,
+                'ttl': self.ttl}
+
+
+def count(name, value=1):
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def counter(name):  # type: (str) -> int
+    return _counters.get(name, 0)
+
+
+def cache_stats():
+    """
+    per-instance statistics of all process-local caches and counters
+    """
+    return {'caches': {name: c.stats() for name, c in _caches.items()},
+            'counters': dict(_counters)}
+
+
+short_url_cache = LRUCache('short_url', max_size=SHORT_URL_LOCAL_SIZE, ttl=SHORT_URL_LOCAL_TTL)
+path_filter_cache = LRUCache('path_filter', max_size=64)
+
+
+def get_long_url(key_name):  # type: (str) -> str
+    """
+    resolve short url key name (domain + "_" + path) to its long url
+    process-local LRU -> memcache (positive, negative and path filter) -> datastore,
+    returns None when the short url does not exist
+    """
+    long_url = short_url_cache.get(key_name)
+    if long_url is not None:
+        return long_url
+    domain, path = key_name.split('_', 1)
+    filter_id = path_filter_id(domain, path)
+    memcache_key = SHORT_URL_MEMCACHE_KEY.format(key_name)
+    missing_key = MISSING_MEMCACHE_KEY.format(key_name)
+    version_key = PATH_FILTER_VERSION_KEY.format(filter_id)
+    cached = memcache.get_multi([memcache_key, missing_key, version_key])
+    if memcache_key in cached:
+        count('short_url.memcache_hits')
+        long_url = cached[memcache_key]
+    elif missing_key in cached:
+        count('short_url.negative_hits')
+        return None
+    elif not _path_may_exist(filter_id, path, cached.get(version_key)):
+        count('short_url.filter_rejections')
+        return None
+    else:
+        count('short_url.memcache_misses')
+        record = Redirect.get_by_id(key_name)
+        if record is None:
+            # short urls created before Redirect existed and not backfilled yet
+            record = ShortURL.get_by_id(key_name)
+        if record is None:
+            memcache.add(missing_key, True, time=MISSING_MEMCACHE_TTL)
+            return None
+        long_url = record.long_url
+        memcache.add(memcache_key, long_url, time=SHORT_URL_MEMCACHE_TTL)
+    short_url_cache.set(key_name, long_url)
+    return long_url
+
+
+def invalidate_short_url(key_name):  # type: (str) -> None
+    short_url_cache.delete(key_name)
+    memcache.delete(SHORT_URL_MEMCACHE_KEY.format(key_name), seconds=INVALIDATION_LOCK_SECONDS)
+
+
+def register_short_url(key_name, long_url):  # type: (str, str) -> None
+    register_short_urls({key_name: long_url})
+
+
+def register_short_urls(long_urls):  # type: (dict) -> None
+    """
+    make newly created short urls (key name -> long url) resolvable:
+    prime memcache, add them to the path filter, drop negative entries
+    """
+    memcache.set_multi({SHORT_URL_MEMCACHE_KEY.format(k): v for k, v in long_urls.items()},
+                       time=SHORT_URL_MEMCACHE_TTL)
+    update_path_filters(added=long_urls.keys())
+    memcache.delete_multi([MISSING_MEMCACHE_KEY.format(k) for k in long_urls], seconds=INVALIDATION_LOCK_SECONDS)
+
+
+def unregister_short_url(key_name):  # type: (str) -> None
+    invalidate_short_url(key_name)
+    update_path_filters(removed=[key_name])
+
+
+def short_urls_version(team_id):  # type: (int) -> str
+    """
+    marker changed whenever a short url of the team is written or deleted and whenever click counts of the team's
+    short urls are flushed to their shards
+    """
+    memcache_keys = [SHORT_URLS_VERSION_KEY.format(team_id), CLICK_COUNTS_VERSION_KEY.format(team_id)]
+    versions = memcache.get_multi(memcache_keys)
+    missing = {k: uuid.uuid4().hex for k in memcache_keys if k not in versions}
+    if missing:
+        not_added = memcache.add_multi(missing)
+        versions.update(missing)
+        if not_added:
+            # set by another request meanwhile
+            versions.update(memcache.get_multi(not_added))
+    return ':'.join(versions[k] for k in memcache_keys)
+
+
+def touch_short_urls(team_id):  # type: (int) -> None
+    memcache.set(SHORT_URLS_VERSION_KEY.format(team_id), uuid.uuid4().hex)
+
+
+def touch_click_counts(team_id):  # type: (int) -> None
+    memcache.set(CLICK_COUNTS_VERSION_KEY.format(team_id), uuid.uuid4().hex)
+
+
+def path_filter_id(domain, path):  # type: (str, str) -> str
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return "{}_{}".format(domain, (zlib.crc32(path) & 0xffffffff) % PATH_FILTER_SHARDS)
+
+
+def _path_may_exist(filter_id, path, version):
+    entry = path_filter_cache.get(filter_id)
+    if entry is None or version is None or entry[0] != version:
+        entry = _load_path_filter(filter_id)
+    path_filter = entry[1]
+    return path_filter is None or path in path_filter
+
+
+def _load_path_filter(filter_id):
+    entity = PathFilter.get_by_id(filter_id)
+    if entity is None:
+        entry = (0, None)
+    elif entity.ready is not True:
+        entry = (entity.version, None)
+    else:
+        entry = (entity.version, CountingBloomFilter(entity.size, entity.hash_count, entity.counters))
+    memcache.add(PATH_FILTER_VERSION_KEY.format(filter_id), entry[0], time=PATH_FILTER_VERSION_TTL)
+    path_filter_cache.set(filter_id, entry)
+    return entry
+
+
+@ndb.transactional
+def _update_path_filter(filter_id, added_paths, removed_paths, rebuilt=None):
+    entity = PathFilter.get_by_id(filter_id)
+    if entity is None:
+        entity = PathFilter(id=filter_id, size=PATH_FILTER_SIZE, hash_count=PATH_FILTER_HASH_COUNT)
+    path_filter = CountingBloomFilter(entity.size, entity.hash_count, entity.counters)
+    for path in added_paths:
+        path_filter.add(path)
+    for path in removed_paths:
+        path_filter.remove(path)
+    if rebuilt is not None:
+        path_filter.merge(rebuilt)
+        entity.ready = True
+    entity.counters = path_filter.to_bytes()
+    entity.version += 1
+    entity.put()
+    return entity.version
+
+
+def _publish_path_filter_version(filter_id, version):
+    memcache.set(PATH_FILTER_VERSION_KEY.format(filter_id), version, time=PATH_FILTER_VERSION_TTL)
+
+
+def update_path_filters(added=(), removed=()):
+    """
+    queue created and deleted short url key names for the path filter shards, flush_path_filters writes them
+    new short urls resolve through the memcache entry register_short_urls primes until then
+    """
+    # workers imports cache, so it is imported here
+    from workers import defer_per_interval
+    changes = {}
+    for key_names, index in ((added, 0), (removed, 1)):
+        for key_name in key_names:
+            domain, path = key_name.split('_', 1)
+            changes.setdefault(path_filter_id(domain, path), ([], []))[index].append(path)
+    if not changes:
+        return
+    tasks = [taskqueue.Task(payload=json.dumps({'filter_id': f, 'added': a, 'removed': r}), method='PULL')
+             for f, (a, r) in changes.items()]
+    try:
+        taskqueue.Queue(PATH_FILTER_QUEUE_NAME).add(tasks)
+    except taskqueue.Error:
+        logging.warning('path filter changes could not be queued, write them directly')
+        _apply_path_filter_changes(changes)
+        return
+    defer_per_interval('path-filter', PATH_FILTER_QUEUE_NAME, PATH_FILTER_FLUSH_INTERVAL, flush_path_filters)
+
+
+def _write_path_filter_changes(changes):  # type: (dict) -> list
+    """
+    write changes (filter id -> (added paths, removed paths)), returns filter ids whose write failed
+    """
+    failed = []
+    for filter_id, (added_paths, removed_paths) in changes.items():
+        try:
+            version = _update_path_filter(filter_id, added_paths, removed_paths)
+        except datastore_errors.Error:
+            logging.warning('path filter update failed: {}'.format(filter_id))
+            failed.append(filter_id)
+            continue
+        _publish_path_filter_version(filter_id, version)
+    return failed
+
+
+def _apply_path_filter_changes(changes):  # type: (dict) -> None
+    failed = _write_path_filter_changes(changes)
+    if failed:
+        deferred.defer(_apply_path_filter_changes, {f: changes[f] for f in failed},
+                       _countdown=PATH_FILTER_FLUSH_INTERVAL)
+
+
+def flush_path_filters():  # type: () -> int
+    """
+    lease queued path filter changes and write them in one transaction per shard,
+    changes of a shard whose write failed stay queued and are leased again when their lease expires
+    a flush failing after the write leases the changes again, counters are then added twice and
+    the paths may stay in the filter after deletion, which only costs a datastore lookup
+    """
+    queue = taskqueue.Queue(PATH_FILTER_QUEUE_NAME)
+    total = 0
+    while True:
+        tasks = queue.lease_tasks(PATH_FILTER_LEASE_SECONDS, PATH_FILTER_LEASE_SIZE)
+        if not tasks:
+            break
+        changes = {}
+        leased = {}
+        for task in tasks:
+            change = json.loads(task.payload)
+            added_paths, removed_paths = changes.setdefault(change['filter_id'], ([], []))
+            added_paths.extend(change['added'])
+            removed_paths.extend(change['removed'])
+            leased.setdefault(change['filter_id'], []).append(task)
+        failed = _write_path_filter_changes(changes)
+        done = [t for filter_id, shard_tasks in leased.items() if filter_id not in failed for t in shard_tasks]
+        if done:
+            queue.delete_tasks(done)
+        total += len(done)
+        if failed:
+            deferred.defer(flush_path_filters, _countdown=PATH_FILTER_LEASE_SECONDS)
+            break
+        if len(tasks) < PATH_FILTER_LEASE_SIZE:
+            break
+    logging.info('{} path filter changes written'.format(total))
+    return total
+
+
+def rebuild_path_filters(domain):  # type: (str) -> str
+    """
+    build the path filter shards of the domain from all existing short urls and mark them ready
+    changes made concurrently are kept, because rebuilt counters are merged into the stored ones
+    """
+    filters = {}
+    q = ShortURL.query(ShortURL.key >= ndb.Key(ShortURL, domain + '_'),
+                       ShortURL.key < ndb.Key(ShortURL, domain + '`'))
+    for key in q.iter(keys_only=True):
+        path = key.id().split('_', 1)[1]
+        filter_id = path_filter_id(domain, path)
+        if filter_id not in filters:
+            filters[filter_id] = CountingBloomFilter(PATH_FILTER_SIZE, PATH_FILTER_HASH_COUNT)
+        filters[filter_id].add(path)
+    for shard in range(PATH_FILTER_SHARDS):
+        filter_id = "{}_{}".format(domain, shard)
+        rebuilt = filters.get(filter_id, CountingBloomFilter(PATH_FILTER_SIZE, PATH_FILTER_HASH_COUNT))
+        version = _update_path_filter(filter_id, [], [], rebuilt)
+        _publish_path_filter_version(filter_id, version)
+    message = 'path filter rebuilt: {}'.format(domain)
+    logging.info(message)
+    return message
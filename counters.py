@@ -0,0 +1,113 @@
+import random
+import logging
+
+from google.appengine.api import memcache, datastore_errors
+from google.appengine.ext import ndb, deferred
+
+from models import ShortURL, Redirect, ClickCounterShard
+from cache import touch_click_counts
+from workers import defer_per_interval
+
+CLICK_COUNTER_SHARDS = 20
+CLICK_COUNT_DELTA_KEY = 'click-count-delta-{}'
+CLICK_COUNT_TOTAL_KEY = 'click-count-total-{}'
+CLICK_COUNT_TOTAL_TTL = 60 * 10
+CLICK_COUNT_FLUSH_INTERVAL = 10
+CLICK_COUNT_FLUSH_LOCK_KEY = 'click-count-flush-{}'
+# longer than a flush takes, a flush killed in between leaves the lock until it expires
+CLICK_COUNT_FLUSH_LOCK_SECONDS = 60
+# keeps readers holding a pre-flush sum from caching it again
+CLICK_COUNT_LOCK_SECONDS = 5
+
+
+def increment_click_count(short_url_id, delta=1):  # type: (str, int) -> None
+    """
+    buffer increments in memcache, flushed by a task per short url and CLICK_COUNT_FLUSH_INTERVAL
+    """
+    value = memcache.incr(CLICK_COUNT_DELTA_KEY.format(short_url_id), delta=delta, initial_value=0)
+    if value is None:
+        logging.warning('memcache incr failed, write click count directly: {}'.format(short_url_id))
+        _add_to_shard_or_defer(short_url_id, delta)
+        return
+    defer_per_interval('click-count', short_url_id, CLICK_COUNT_FLUSH_INTERVAL, flush_click_count, short_url_id)
+
+
+def flush_click_count(short_url_id):  # type: (str) -> None
+    """
+    the shard is written before the delta is taken out of memcache, a failed write is retried with the clicks kept
+    """
+    delta_key = CLICK_COUNT_DELTA_KEY.format(short_url_id)
+    lock_key = CLICK_COUNT_FLUSH_LOCK_KEY.format(short_url_id)
+    if not memcache.add(lock_key, 1, time=CLICK_COUNT_FLUSH_LOCK_SECONDS):
+        # another flush of the short url is running, it may not have taken its delta out yet
+        deferred.defer(flush_click_count, short_url_id, _countdown=CLICK_COUNT_FLUSH_INTERVAL)
+        return
+    try:
+        value = memcache.get(delta_key)
+        if not value:
+            return
+        value = int(value)
+        _add_to_shard(short_url_id, value)
+        # increments made after get are kept by decr, a later flush picks them up
+        if memcache.decr(delta_key, delta=value) is None:
+            logging.error('click count delta could not be decremented, counted again: {}'.format(short_url_id))
+        _counted(short_url_id)
+    finally:
+        memcache.delete(lock_key)
+
+
+def _counted(short_url_id):
+    memcache.delete(CLICK_COUNT_TOTAL_KEY.format(short_url_id), seconds=CLICK_COUNT_LOCK_SECONDS)
+    # listings of the team show the click count, their ETags change with it
+    record = Redirect.get_by_id(short_url_id) or ShortURL.get_by_id(short_url_id)
+    if record is not None:
+        touch_click_counts(record.team.id())
+
+
+@ndb.transactional
+def _add_to_shard(short_url_id, delta):
+    shard_key = ndb.Key(ClickCounterShard, '{}_{}'.format(short_url_id, random.randint(0, CLICK_COUNTER_SHARDS - 1)))
+    shard = shard_key.get()
+    if shard is None:
+        shard = ClickCounterShard(key=shard_key, short_url=ndb.Key(ShortURL, short_url_id))
+    shard.count += delta
+    shard.put()
+
+
+def _add_to_shard_or_defer(short_url_id, delta):
+    try:
+        _add_to_shard(short_url_id, delta)
+    except datastore_errors.TransactionFailedError:
+        deferred.defer(_add_to_shard, short_url_id, delta)
+        return
+    _counted(short_url_id)
+
+
+def get_click_counts(short_url_ids):  # type: (list) -> dict
+    """
+    click totals by short url key name, shard sums are cached and the pending memcache delta is added
+    """
+    cached = memcache.get_multi([CLICK_COUNT_TOTAL_KEY.format(i) for i in short_url_ids] +
+                                [CLICK_COUNT_DELTA_KEY.format(i) for i in short_url_ids])
+    totals = {}
+    missing = []
+    for short_url_id in short_url_ids:
+        total = cached.get(CLICK_COUNT_TOTAL_KEY.format(short_url_id))
+        if total is None:
+            missing.append(short_url_id)
+        else:
+            totals[short_url_id] = total
+    if missing:
+        shard_keys = [ndb.Key(ClickCounterShard, '{}_{}'.format(i, n))
+                      for i in missing for n in range(CLICK_COUNTER_SHARDS)]
+        for short_url_id in missing:
+            totals[short_url_id] = 0
+        for shard in ndb.get_multi(shard_keys):
+            if shard is not None:
+                totals[shard.short_url.id()] += shard.count
+        memcache.add_multi({CLICK_COUNT_TOTAL_KEY.format(i): totals[i] for i in missing}, time=CLICK_COUNT_TOTAL_TTL)
+    return {i: totals[i] + int(cached.get(CLICK_COUNT_DELTA_KEY.format(i)) or 0) for i in short_url_ids}
+
+
+def get_click_count(short_url_id):  # type: (str) -> int
+    return get_click_counts([short_url_id])[short_url_id]
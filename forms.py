@@ -33,14 +33,27 @@ class LongURLForm(Form):
             raise ValidationError(message='Invalid domain name')
 
     def validate_custom_path(form, field):
-        if field.data is not None and (field.data) > 0 and re.match(ur'^[a-z0-9]*$', field.data) is None:
-            raise ValidationError(message='Invalid custom path name, should be lower case alphabet and number')
+        validate_custom_path_format(field)
         key_name = "{}_{}".format(form.domain.data, field.data)
         short_url = ShortURL.get_by_id(key_name)
         if short_url is not None:
             raise ValidationError(message='The short URL path exists already')
 
 
+class BatchLongURLForm(LongURLForm):
+    """
+    item of a batch shorten request, existence of custom paths is checked for the whole batch at once
+    """
+
+    def validate_custom_path(form, field):
+        validate_custom_path_format(field)
+
+
+def validate_custom_path_format(field):
+    if field.data is not None and (field.data) > 0 and re.match(ur'^[a-z0-9]*$', field.data) is None:
+        raise ValidationError(message='Invalid custom path name, should be lower case alphabet and number')
+
+
 class UpdateShortURLForm(Form):
     tag = StringField('Tag',
                       [validators.optional(),
@@ -56,8 +69,16 @@ class UpdateShortURLForm(Form):
 
 
 class InvitationForm(Form):
-    email = StringField('Email', [
-        validators.Email('Invalid email address')])
+    # one address or several separated by commas
+    email = StringField('Email')
+
+    def validate_email(form, field):
+        emails = form.emails()
+        if len(emails) == 0 or any(altvalidator.email(e) is not True for e in emails):
+            raise ValidationError(message='Invalid email address')
+
+    def emails(self):
+        return [e.strip() for e in (self.email.data or '').split(',') if e.strip()]
 
 
 class RoleForm(Form):
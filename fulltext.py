@@ -0,0 +1,167 @@
+import re
+import time
+import logging
+import threading
+
+from models import ShortURL
+
+try:
+    from google.appengine.api import search
+except ImportError:
+    search = None
+
+SEARCH_INDEX_NAME = 'short-urls-{}'
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGE_SIZE = 100
+# the Search API accepts up to 200 documents per put and delete
+SEARCH_BATCH_SIZE = 200
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):  # type: (unicode) -> list
+    return TOKEN_PATTERN.findall((text or u'').lower())
+
+
+def short_url_document(short_url):  # type: (ShortURL) -> dict
+    """
+    searchable fields of a short url, rank orders newer short urls first
+    """
+    created_at = short_url.created_at
+    return {
+        'id': short_url.key.id(),
+        'team_id': short_url.team.id(),
+        'rank': int(time.mktime(created_at.timetuple())) if created_at else int(time.time()),
+        'title': short_url.title or u'',
+        'description': short_url.description or u'',
+        'site_name': short_url.site_name or u'',
+        'long_url': short_url.long_url or u'',
+        'memo': short_url.memo or u'',
+        'tags': list(short_url.tags or []),
+    }
+
+
+class SearchAPIIndex(object):
+    """
+    App Engine Search API index per team, queries match all words of the query
+    """
+
+    def _index(self, team_id):
+        return search.Index(name=SEARCH_INDEX_NAME.format(team_id))
+
+    def put(self, documents):  # type: (list) -> None
+        by_team = {}
+        for document in documents:
+            fields = [search.TextField(name=name, value=document[name])
+                      for name in ('title', 'description', 'site_name', 'long_url', 'memo')]
+            fields.extend(search.TextField(name='tags', value=tag) for tag in document['tags'])
+            by_team.setdefault(document['team_id'], []).append(
+                search.Document(doc_id=document['id'], fields=fields, rank=document['rank']))
+        for team_id, search_documents in by_team.items():
+            for i in range(0, len(search_documents), SEARCH_BATCH_SIZE):
+                self._index(team_id).put(search_documents[i:i + SEARCH_BATCH_SIZE])
+
+    def delete(self, team_id, doc_ids):  # type: (int, list) -> None
+        for i in range(0, len(doc_ids), SEARCH_BATCH_SIZE):
+            self._index(team_id).delete(doc_ids[i:i + SEARCH_BATCH_SIZE])
+
+    def search(self, team_id, query, limit, cursor=None):  # type: (int, unicode, int, str) -> (list, str)
+        words = tokenize(query)
+        if not words:
+            return [], None
+        # quoting every word keeps the query syntax out of user input
+        query_string = u' '.join(u'"{}"'.format(w) for w in words)
+        options = search.QueryOptions(limit=limit, ids_only=True,
+                                      cursor=search.Cursor(web_safe_string=cursor) if cursor else search.Cursor())
+        results = self._index(team_id).search(search.Query(query_string=query_string, options=options))
+        next_cursor = results.cursor.web_safe_string if results.cursor else None
+        return [d.doc_id for d in results.results], next_cursor
+
+
+class InvertedIndex(object):
+    """
+    process-local inverted index with the same interface as SearchAPIIndex for local runs and tests
+    every instance has its own index, short urls written by other instances are not found
+    """
+
+    def __init__(self):
+        self._postings = {}  # team_id -> token -> set of doc ids
+        self._documents = {}  # doc id -> (team_id, rank, tokens)
+        self._lock = threading.Lock()
+
+    def _remove(self, doc_id):
+        team_id, _, tokens = self._documents.pop(doc_id)
+        postings = self._postings[team_id]
+        for token in tokens:
+            postings[token].discard(doc_id)
+            if not postings[token]:
+                del postings[token]
+
+    def put(self, documents):
+        with self._lock:
+            for document in documents:
+                if document['id'] in self._documents:
+                    self._remove(document['id'])
+                tokens = set()
+                for name in ('title', 'description', 'site_name', 'long_url', 'memo'):
+                    tokens.update(tokenize(document[name]))
+                for tag in document['tags']:
+                    tokens.update(tokenize(tag))
+                self._documents[document['id']] = (document['team_id'], document['rank'], tokens)
+                postings = self._postings.setdefault(document['team_id'], {})
+                for token in tokens:
+                    postings.setdefault(token, set()).add(document['id'])
+
+    def delete(self, team_id, doc_ids):
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self._documents:
+                    self._remove(doc_id)
+
+    def search(self, team_id, query, limit, cursor=None):
+        words = tokenize(query)
+        if not words:
+            return [], None
+        offset = int(cursor) if cursor else 0
+        with self._lock:
+            postings = self._postings.get(team_id, {})
+            # intersect from the rarest word
+            matches = None
+            for word in sorted(set(words), key=lambda w: len(postings.get(w, ()))):
+                matches = set(postings.get(word, ())) if matches is None else matches & postings.get(word, set())
+                if not matches:
+                    return [], None
+            ranked = sorted(matches, key=lambda doc_id: (-self._documents[doc_id][1], doc_id))
+        page = ranked[offset:offset + limit]
+        next_cursor = str(offset + limit) if offset + limit < len(ranked) else None
+        return page, next_cursor
+
+
+def index_short_urls(short_urls):  # type: (list) -> None
+    """
+    failures are logged, the short urls are written already and are indexed again by the next change or reindex
+    """
+    try:
+        search_index.put([short_url_document(s) for s in short_urls])
+    except Exception:
+        logging.exception('failed to index short urls')
+
+
+def unindex_short_urls(short_urls):  # type: (list) -> None
+    by_team = {}
+    for short_url in short_urls:
+        by_team.setdefault(short_url.team.id(), []).append(short_url.key.id())
+    try:
+        for team_id, doc_ids in by_team.items():
+            search_index.delete(team_id, doc_ids)
+    except Exception:
+        logging.exception('failed to unindex short urls')
+
+
+def search_short_urls(team_id, query, limit=SEARCH_PAGE_SIZE, cursor=None):  # type: (int, unicode, int, str) -> tuple
+    """
+    key names of the team's short urls matching all words of query and the cursor of the next page
+    """
+    return search_index.search(team_id, query, limit, cursor)
+
+
+search_index = SearchAPIIndex() if search is not None else InvertedIndex()
@@ -0,0 +1,90 @@
+import timeit
+import threading
+
+BASE36_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+BASE62_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# base62 gives shorter paths, but they are case sensitive
+SHORT_URL_ALPHABET = BASE36_ALPHABET
+ID_BLOCK_SIZE = 100
+
+
+def encode_id(nid, alphabet=BASE36_ALPHABET):  # type: (int, str) -> str
+    base = len(alphabet)
+    s = []
+    while nid:
+        nid, c = divmod(nid, base)
+        s.append(alphabet[c])
+    s.reverse()
+    return "".join(s)
+
+
+def datastore_allocator(model_class):
+    """
+    allocator reserving ranges of the model's ids with allocate_ids, no entity is written
+    """
+    def allocate(size):
+        return model_class.allocate_ids(size=size)
+    return allocate
+
+
+class LocalIDAllocator(object):
+    """
+    process-local stand-in of allocate_ids for tests and benchmarks
+    """
+
+    def __init__(self, start=1):
+        self.next = start
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, size):  # type: (int) -> (int, int)
+        with self._lock:
+            first = self.next
+            self.next += size
+            self.calls += 1
+        return first, first + size - 1
+
+
+class IDPool(object):
+    """
+    hands out ids from blocks reserved by allocate(size) -> (first, last), one allocation per block_size ids
+    ids left in the pool when the instance shuts down are never used
+    """
+
+    def __init__(self, allocate, block_size=ID_BLOCK_SIZE):
+        self.allocate = allocate
+        self.block_size = block_size
+        self._next = 0
+        self._last = -1
+        self._lock = threading.Lock()
+
+    def next_id(self):  # type: () -> int
+        return self.next_ids(1)[0]
+
+    def next_ids(self, count):  # type: (int) -> list
+        """
+        count ids, a request larger than block_size is reserved with one allocation
+        """
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                if self._next > self._last:
+                    self._next, self._last = self.allocate(max(self.block_size, count - len(ids)))
+                taken = min(count - len(ids), self._last - self._next + 1)
+                ids.extend(range(self._next, self._next + taken))
+                self._next += taken
+        return ids
+
+    def remaining(self):  # type: () -> int
+        with self._lock:
+            return self._last - self._next + 1
+
+
+if __name__ == '__main__':
+    number = 100000
+    pool = IDPool(LocalIDAllocator())
+    print('next_id: {:.2f} usec'.format(timeit.timeit(pool.next_id, number=number) / number * 1e6))
+    for name, alphabet in (('base36', BASE36_ALPHABET), ('base62', BASE62_ALPHABET)):
+        elapsed = timeit.timeit(lambda: encode_id(pool.next_id(), alphabet), number=number)
+        print('next_id + {}: {:.2f} usec, {}'.format(name, elapsed / number * 1e6,
+                                                     encode_id(2 ** 40, alphabet)))
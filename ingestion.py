@@ -0,0 +1,151 @@
+import json
+import time
+import uuid
+import logging
+import threading
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb, deferred
+
+from models import ShortURL
+from tasks import build_click, write_click_log, write_click_logs_to_bq
+from counters import increment_click_count
+from rollups import aggregate_clicks, apply_rollup_deltas
+
+# 'deferred': one deferred task per click, 'pull': clicks are buffered and written in batches
+CLICK_INGESTION_MODE = 'deferred'
+CLICK_QUEUE_NAME = 'click-log'
+CLICK_BATCH_SIZE = 100
+CLICK_FLUSH_INTERVAL = 10
+CLICK_LEASE_SECONDS = 60
+CLICK_FLUSH_URL = '/_admin/clicks/flush'
+
+
+class TaskQueueClickBuffer(object):
+    """
+    clicks buffered in a pull queue, a named push task per flush interval makes the worker lease them
+    """
+
+    def __init__(self, queue_name=CLICK_QUEUE_NAME, flush_interval=CLICK_FLUSH_INTERVAL):
+        self.queue_name = queue_name
+        self.flush_interval = flush_interval
+        self._scheduled_bucket = None
+
+    def add(self, payload):
+        taskqueue.Queue(self.queue_name).add(taskqueue.Task(payload=json.dumps(payload), method='PULL'))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        bucket = int(time.time() / self.flush_interval)
+        if bucket == self._scheduled_bucket:
+            return
+        try:
+            taskqueue.add(name='click-flush-{}'.format(bucket), url=CLICK_FLUSH_URL,
+                          countdown=self.flush_interval)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+        self._scheduled_bucket = bucket
+
+    def lease(self, size):
+        tasks = taskqueue.Queue(self.queue_name).lease_tasks(CLICK_LEASE_SECONDS, size)
+        return [(t, json.loads(t.payload)) for t in tasks]
+
+    def delete(self, handles):
+        taskqueue.Queue(self.queue_name).delete_tasks(handles)
+
+
+class InMemoryClickBuffer(object):
+    """
+    process-local stand-in of the pull queue for tests and local development
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.leased = {}
+        self._lock = threading.Lock()
+
+    def add(self, payload):
+        with self._lock:
+            self.pending.append((uuid.uuid4().hex, payload))
+
+    def lease(self, size):
+        with self._lock:
+            leased, self.pending = self.pending[:size], self.pending[size:]
+            self.leased.update(leased)
+        return leased
+
+    def delete(self, handles):
+        with self._lock:
+            for handle in handles:
+                self.leased.pop(handle, None)
+
+
+click_buffer = TaskQueueClickBuffer()
+
+
+def record_click(short_url_key_name, referrer, ip_address,
+                 location_country, location_region, location_city, location_lat_long,
+                 user_agent, get_parameters):
+    if CLICK_INGESTION_MODE != 'pull':
+        deferred.defer(write_click_log, ndb.Key(ShortURL, short_url_key_name), referrer, ip_address,
+                       location_country, location_region, location_city, location_lat_long,
+                       user_agent, get_parameters)
+        return
+    # the id is fixed at ingestion, so clicks leased again after a failed flush are overwritten, not duplicated
+    click_buffer.add({'click_id': uuid.uuid4().int >> 65,
+                      'short_url_id': short_url_key_name,
+                      'referrer': referrer,
+                      'ip_address': ip_address,
+                      'location_country': location_country,
+                      'location_region': location_region,
+                      'location_city': location_city,
+                      'location_lat_long': location_lat_long,
+                      'user_agent': str(user_agent),
+                      'get_parameters': {'c': get_parameters.get('c')}})
+
+
+def flush_clicks(buffer=None, batch_size=CLICK_BATCH_SIZE):  # type: (object, int) -> int
+    """
+    lease buffered clicks in batches, write them with put_multi and forward them to BigQuery
+    counts and rollups are only added for clicks not written yet, so a batch leased again is not counted twice
+    """
+    buffer = buffer or click_buffer
+    total = 0
+    while True:
+        leased = buffer.lease(batch_size)
+        if not leased:
+            break
+        clicks = []
+        for handle, payload in leased:
+            try:
+                clicks.append(build_click(ndb.Key(ShortURL, payload['short_url_id']),
+                                          payload['referrer'],
+                                          payload['ip_address'],
+                                          payload['location_country'],
+                                          payload['location_region'],
+                                          payload['location_city'],
+                                          payload['location_lat_long'],
+                                          payload['user_agent'],
+                                          payload['get_parameters'],
+                                          click_id=payload['click_id']))
+            except (KeyError, TypeError, ValueError):
+                logging.exception('drop broken click payload: {}'.format(payload))
+        # clicks of a batch leased again were written by the failed flush, they are counted already
+        existing = ndb.get_multi([c.key for c in clicks])
+        new_clicks = [c for c, e in zip(clicks, existing) if e is None]
+        ndb.put_multi(new_clicks)
+        if clicks:
+            # insert ids keep BigQuery from inserting the clicks written before twice
+            deferred.defer(write_click_logs_to_bq, [c.key.id() for c in clicks])
+        click_counts = {}
+        for click in new_clicks:
+            click_counts[click.short_url.id()] = click_counts.get(click.short_url.id(), 0) + 1
+        for short_url_id, delta in click_counts.items():
+            increment_click_count(short_url_id, delta)
+        apply_rollup_deltas(aggregate_clicks(new_clicks))
+        buffer.delete([handle for handle, payload in leased])
+        total += len(leased)
+        if len(leased) < batch_size:
+            break
+    logging.info('{} clicks flushed'.format(total))
+    return total
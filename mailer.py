@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+import threading
+
+import sendgrid
+
+MAIL_CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
+
+
+class SendGridTransport(object):
+    """
+    sends SendGrid template mails, config.json and the API client are loaded once per instance
+    """
+
+    def __init__(self, config_file=MAIL_CONFIG_FILE):
+        self.config_file = config_file
+        self._config = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _client_and_config(self):
+        with self._lock:
+            if self._client is None:
+                with open(self.config_file, 'r') as config_file:
+                    self._config = json.loads(config_file.read())
+                self._client = sendgrid.SendGridAPIClient(apikey=self._config['sendgrid_api_key'])
+            return self._client, self._config
+
+    def send(self, personalizations, sender_name):  # type: (list, str) -> bool
+        """
+        one request for all personalizations, each of them is delivered as a separate mail
+        """
+        client, config = self._client_and_config()
+        payload = {
+            "personalizations": personalizations,
+            "from": {
+                "email": config['sendgrid_from_email'],
+                "name": sender_name
+            },
+            "template_id": config['sendgrid_template_id']
+        }
+        try:
+            response = client.client.mail.send.post(request_body=payload)
+        except Exception as e:
+            logging.error(getattr(e, 'body', e))
+            return False
+        if response.status_code != 202:
+            logging.error(response.body)
+            return False
+        return True
+
+
+class FakeMailTransport(object):
+    """
+    offline stand-in of SendGridTransport, send fails fail_times times before it succeeds
+    """
+
+    def __init__(self, fail_times=0):
+        self.sent = []
+        self.fail_times = fail_times
+        self.send_calls = 0
+
+    def send(self, personalizations, sender_name):
+        self.send_calls += 1
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            return False
+        self.sent.extend(personalizations)
+        return True
+
+
+mail_transport = SendGridTransport()
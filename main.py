@@ -14,44 +14,55 @@
 
 # [START app]
 import os
+import hashlib
 import logging
 import datetime
 import uuid
 from functools import wraps
-from urllib2 import HTTPError
 from urlparse import urlparse
-from StringIO import StringIO
 
-import opengraph
 import wtforms_json
-from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, send_file
-import qrcode
+import cloudstorage
+from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, Response, \
+    stream_with_context, g, abort
 
-from forms import RegistrationForm, LongURLForm, UpdateShortURLForm, InvitationForm, RoleForm
+from forms import RegistrationForm, LongURLForm, BatchLongURLForm, UpdateShortURLForm, InvitationForm, RoleForm
 from google.appengine.api import users, memcache
-from google.appengine.ext import ndb, deferred
+from google.appengine.ext import ndb
 from google.appengine.datastore.datastore_query import Cursor
-from models import Team, User, ShortURL, ShortURLID, Invitation, Click, APIToken
-from tasks import write_click_log, send_invitation
+from models import Team, User, ShortURL, ShortURLID, Invitation, APIToken, Redirect, ClickRollup, LongURLIndex, \
+    TagSummary, QRExport
+from tasks import defer_invitations, defer_enrichment, defer_qr_export
+from fulltext import index_short_urls, unindex_short_urls, search_short_urls, SEARCH_PAGE_SIZE, \
+    SEARCH_MAX_PAGE_SIZE
+from ingestion import record_click
+from counters import get_click_count, get_click_counts
+from rollups import ROLLUP_GRANULARITIES, stream_rollups
+from auth import validate_team_user, resolve_token, hash_token, invalidate_token, NEW_TOKEN_MEMCACHE_KEY, \
+    NEW_TOKEN_MEMCACHE_TTL
+from cache import get_long_url, invalidate_short_url, register_short_url, register_short_urls, unregister_short_url, \
+    short_urls_version, touch_short_urls
+from qr import get_qr, qr_id, QR_MIMETYPES, QR_ERROR_LEVELS, QR_DEFAULT_FORMAT, QR_DEFAULT_ERROR_LEVEL, \
+    QR_DEFAULT_SIZE, QR_MIN_SIZE, QR_MAX_SIZE
+from idpool import IDPool, datastore_allocator, encode_id, SHORT_URL_ALPHABET
 
 wtforms_json.init()
 app = Flask(__name__)
 
+# daily rollups per page of /api/v1/data
+DATA_PAGE_SIZE = 90
+DATA_MAX_PAGE_SIZE = 400
+# days shown by the chart of the detail page, up to today
+DATA_CHART_DAYS = 90
+LIST_PAGE_SIZE = 10
+LIST_MAX_PAGE_SIZE = 100
+QR_MAX_AGE = 60 * 60 * 24 * 365
+QR_EXPORT_MAX_SIZE = 1000
+QR_EXPORT_READ_SIZE = 1024 * 1024
 
-def validate_team_user(team_id, user_id):  # type(str, str) -> str
-    team_user_id = "{}_{}".format(team_id, user_id)
-    memcache_key = "validation-{}".format(team_user_id)
-    validation_result = memcache.get(memcache_key)
-    if validation_result:
-        return validation_result
-    team_user = User.get_by_id(team_user_id)
-    if team_user and team_user.in_use is True:
-        team = team_user.team.get()
-        team_name = team.team_name
-        memcache.set(memcache_key, team_name)
-        return team_name
-    logging.info('validation failed: team_id = {}, user_id = {}'.format(team_id, user_id))
-    return ''
+SHORTEN_BATCH_MAX_SIZE = 500
+
+short_url_id_pool = IDPool(datastore_allocator(ShortURLID))
 
 
 def team_id_required(f):
@@ -63,9 +74,12 @@ def team_id_required(f):
             access_token_key = request.get_json().get('access_token', False)
             if access_token_key is False:
                 return make_response(jsonify({'errors': ['bad request, should have access token data']}), 401)
-            access_token_entity = APIToken.get_by_id(access_token_key)
-            team_id = access_token_entity.team.id()
-            user_id = ''.join(access_token_entity.created_by.id().split('_')[-1:])
+            resolved = resolve_token(access_token_key)
+            if resolved is None:
+                return make_response(jsonify({'errors': ['bad request, the access token does not exist']}), 401)
+            team_id, user_id, revoked = resolved
+            if revoked:
+                return make_response(jsonify({'errors': ['bad request, the access token was revoked']}), 401)
             team_name = validate_team_user(team_id, user_id)
         else:
             user_id = users.get_current_user().user_id()
@@ -73,17 +87,37 @@ def team_id_required(f):
         if team_name == '':
             return make_response(jsonify({'errors': ['bad request, should have team session data']}), 401)
         team_user_id = "{}_{}".format(team_id, user_id)
+        g.team_user_id = team_user_id
+        g.team_key = ndb.Key(Team, int(team_id))
         return f(team_id, team_name, team_user_id, *args, **kwargs)
 
     return decorated_function
 
 
+def current_user():  # type: () -> User
+    """
+    User of the request validated by team_id_required, got once on first use
+    answers 401 when the user was deleted since it was validated
+    """
+    if 'user' not in g:
+        g.user = User.get_by_id(g.team_user_id)
+    if g.user is None:
+        abort(make_response(jsonify({'errors': ['bad request, should have team session data']}), 401))
+    return g.user
+
+
 def strip_scheme(url):
     parsed = urlparse(url)
     scheme = "%s://" % parsed.scheme
     return parsed.geturl().replace(scheme, '', 1).rstrip('/')
 
 
+def parse_date(value):  # type: (str) -> datetime.date
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
 def is_local():
     return os.environ["SERVER_NAME"] in ("localhost", "www.lexample.com")
 
@@ -177,36 +211,49 @@ def signout(team_id, team_name, team_user_id):
     return response
 
 
+@ndb.tasklet
+def team_api_tokens_async(team_key):
+    keys = yield APIToken.query().filter(APIToken.team == team_key).order(-APIToken.created_at).fetch_async(
+        1000, keys_only=True)
+    api_tokens = yield ndb.get_multi_async(keys)
+    raise ndb.Return([t for t in api_tokens if t is not None])
+
+
 @app.route('/page/settings', methods=['GET', 'POST'])
 @team_id_required
 def settings(team_id, team_name, team_user_id):
     form = InvitationForm(request.form)
     messages = []
     errors = []
-    team_users = User.query().filter(User.team == Team.get_by_id(int(team_id)).key).order(-Team.created_at).fetch()
-    team_user_dic = {u.key.id(): u.user_name for u in team_users}
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    # independent RPCs run concurrently, the page waits for the slowest one only
+    team_users_future = User.query().filter(User.team == g.team_key).order(-Team.created_at).fetch_async()
+    api_tokens_future = team_api_tokens_async(g.team_key)
+    new_token_key = NEW_TOKEN_MEMCACHE_KEY.format(team_user_id)
+    new_token_future = ndb.get_context().memcache_get(new_token_key)
+    user_entity = current_user()
     if request.method == 'POST' and form.validate():
         if is_local():
             host_name = 'jmpt.me'
         else:
             host_name = request.host
-        result = send_invitation(form.email.data, team_id, users.get_current_user().user_id(), host_name)
-        if result:
-            messages.append('Invitation sent')
-        else:
-            errors.append('Invitation sent failed')
-    qo = ndb.QueryOptions(keys_only=True)
-    api_token_query = APIToken.query().filter(APIToken.team == Team.get_by_id(int(team_id)).key).order(
-        -APIToken.created_at).fetch(1000, options=qo)
-    api_token_query_results = ndb.get_multi(api_token_query)
-    api_tokens = [{'token': t.key.id(), 'created_by': team_user_dic[t.created_by.id()], 'created_at': str(t.created_at)}
-                  for t in api_token_query_results if t is not None]
+        invitations = [Invitation(id=uuid.uuid4().hex, sent_to=email, team=g.team_key, created_by=user_entity.key)
+                       for email in form.emails()]
+        ndb.put_multi(invitations)
+        defer_invitations([i.key.id() for i in invitations], host_name)
+        messages.append('Invitation sent')
+    team_users = team_users_future.get_result()
+    team_user_dic = {u.key.id(): u.user_name for u in team_users}
+    api_tokens = [{'token': t.key.id(), 'hint': t.hint or t.key.id()[-4:], 'revoked': t.revoked is True,
+                   'created_by': team_user_dic[t.created_by.id()], 'created_at': str(t.created_at)}
+                  for t in api_tokens_future.get_result()]
+    new_token = new_token_future.get_result()
+    if new_token is not None:
+        memcache.delete(new_token_key)
     return render_template('team_settings.html',
                            team_name=team_name,
                            team_users=team_users,
                            api_tokens=api_tokens,
+                           new_token=new_token,
                            current_user=user_entity,
                            form=form,
                            messages=messages,
@@ -216,12 +263,12 @@ def settings(team_id, team_name, team_user_id):
 @app.route('/page/token', methods=['POST'])
 @team_id_required
 def generate_token(team_id, team_name, team_user_id):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     if user_entity.role in ['primary_owner', 'admin']:
-        key_name = uuid.uuid4().hex
-        api_token = APIToken(id=key_name, team=user_entity.team, created_by=user_entity.key).put()
-        api_token.get()
+        token = uuid.uuid4().hex
+        APIToken(id=hash_token(token), team=user_entity.team, created_by=user_entity.key, hint=token[-4:]).put()
+        # shown once on the settings page
+        memcache.set(NEW_TOKEN_MEMCACHE_KEY.format(team_user_id), token, time=NEW_TOKEN_MEMCACHE_TTL)
         response = make_response(redirect(url_for('settings')))
         return response
     logging.info('this user does not have enough role to make token')
@@ -231,12 +278,12 @@ def generate_token(team_id, team_name, team_user_id):
 @app.route('/page/delete/token/<token_id>', methods=['post'])
 @team_id_required
 def delete_token(team_id, team_name, team_user_id, token_id):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     if user_entity.role in ['primary_owner', 'admin']:
         api_token = APIToken.get_by_id(token_id)
         if api_token.team.id() == user_entity.team.id():
             api_token.key.delete()
+            invalidate_token(token_id)
             response = make_response(redirect(url_for('settings')))
             return response
         logging.info('the team {} of this user does not match to the token team {}'.format(user_entity.team.id(),
@@ -246,11 +293,29 @@ def delete_token(team_id, team_name, team_user_id, token_id):
     return render_template('invalid.html'), 400
 
 
+@app.route('/page/revoke/token/<token_id>', methods=['post'])
+@team_id_required
+def revoke_token(team_id, team_name, team_user_id, token_id):
+    user_entity = current_user()
+    if user_entity.role in ['primary_owner', 'admin']:
+        api_token = APIToken.get_by_id(token_id)
+        if api_token.team.id() == user_entity.team.id():
+            api_token.revoked = True
+            api_token.put()
+            invalidate_token(token_id)
+            response = make_response(redirect(url_for('settings')))
+            return response
+        logging.info('the team {} of this user does not match to the token team {}'.format(user_entity.team.id(),
+                                                                                           api_token.team.id()))
+        return render_template('invalid.html'), 400
+    logging.info('this user does not have enough role to revoke token')
+    return render_template('invalid.html'), 400
+
+
 @app.route('/page/role', methods=['POST'])
 @team_id_required
 def change_role(team_id, team_name, team_user_id):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     form = RoleForm(request.form)
     if request.method == 'POST' and form.validate():
         if user_entity.role in ['admin', 'primary_owner']:
@@ -301,115 +366,397 @@ def accept_invitation(invitation_id):
 @app.route('/page/detail/<short_url_domain>/<short_url_path>', methods=['GET'])
 @team_id_required
 def detail(team_id, team_name, team_user_id, short_url_domain, short_url_path):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     short_url = ShortURL.get_by_id("{}_{}".format(short_url_domain, short_url_path))
     if short_url is None:
         return make_response(render_template('404.html'), 404)
     if short_url.team != user_entity.team:
         return make_response(jsonify({'errors': ['you can not edit this short url']}), 401)
+    chart_from = datetime.datetime.utcnow().date() - datetime.timedelta(days=DATA_CHART_DAYS - 1)
     return render_template('detail.html', short_url=short_url, team_name=team_name, short_url_domain=short_url_domain,
-                           short_url_path=short_url_path)
+                           short_url_path=short_url_path, chart_from=chart_from.strftime('%Y-%m-%d'))
+
+
+def parse_qr_options(values):  # type: (dict) -> ((str, str, int), list)
+    """
+    format, error correction level and size of QR codes from query parameters or a JSON payload
+    """
+    image_format = unicode(values.get('format') or QR_DEFAULT_FORMAT).lower()
+    error_level = unicode(values.get('level') or QR_DEFAULT_ERROR_LEVEL).upper()
+    try:
+        size = int(values.get('size', QR_DEFAULT_SIZE))
+    except (TypeError, ValueError):
+        size = None
+    errors = []
+    if image_format not in QR_MIMETYPES:
+        errors.append('format should be png or svg')
+    if error_level not in QR_ERROR_LEVELS:
+        errors.append('level should be L, M, Q or H')
+    if size is None or not QR_MIN_SIZE <= size <= QR_MAX_SIZE:
+        errors.append('size should be {} to {}'.format(QR_MIN_SIZE, QR_MAX_SIZE))
+    return (image_format, error_level, size), errors
 
 
 @app.route('/image/qr/<short_url_domain>/<short_url_path>', methods=['GET'])
 @team_id_required
 def generate_qrcode(team_id, team_name, team_user_id, short_url_domain, short_url_path):
-    short_url = ShortURL.get_by_id("{}_{}".format(short_url_domain, short_url_path))
-    if short_url is None:
+    (image_format, error_level, size), errors = parse_qr_options(request.args)
+    if errors:
+        return make_response(jsonify({'errors': errors}), 400)
+    # cached lookup of the redirect instead of a ShortURL get
+    if get_long_url("{}_{}".format(short_url_domain, short_url_path)) is None:
         return make_response(render_template('404.html'), 404)
-    qrcode_image = qrcode.make('https://{}/{}'.format(short_url_domain, short_url_path))
-    image_io = StringIO()
-    qrcode_image.save(image_io)
-    image_io.seek(0)
-    return send_file(image_io, mimetype='image/png')
+    etag = qr_id(short_url_domain, short_url_path, size, error_level, image_format)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(get_qr(short_url_domain, short_url_path, size, error_level, image_format))
+        response.mimetype = QR_MIMETYPES[image_format]
+    response.set_etag(etag)
+    # the image of a short url never changes, private because the endpoint needs the team session
+    response.headers['Cache-Control'] = 'private, max-age={}'.format(QR_MAX_AGE)
+    return response
+
+
+def qr_export_result(export):  # type: (QRExport) -> dict
+    result = {'id': export.key.id(), 'status': export.status, 'count': len(export.short_urls),
+              'failed': [k.replace('_', '/', 1) for k in export.failed], 'download_url': None}
+    if export.status == 'done':
+        result['download_url'] = url_for('download_qr_export', export_id=export.key.id())
+    return result
+
 
+@app.route('/api/v1/qr/exports', methods=['POST'])
+@team_id_required
+def create_qr_export(team_id, team_name, team_user_id):
+    json_data = request.get_json() or {}
+    (image_format, error_level, size), errors = parse_qr_options(json_data)
+    if errors:
+        return make_response(jsonify({'errors': errors}), 400)
+    if json_data.get('tag'):
+        q = ShortURL.query(ShortURL.team == g.team_key, ShortURL.tags == json_data['tag'])
+        key_names = [k.id() for k in q.order(-ShortURL.created_at).fetch(QR_EXPORT_MAX_SIZE + 1, keys_only=True)]
+    elif isinstance(json_data.get('short_urls'), list) and json_data['short_urls']:
+        # short urls as returned by the API, domain/path
+        requested = []
+        for short_url in json_data['short_urls'][:QR_EXPORT_MAX_SIZE + 1]:
+            key_name = unicode(short_url).replace('/', '_', 1)
+            if key_name not in requested:
+                requested.append(key_name)
+        entities = ndb.get_multi([ndb.Key(ShortURL, k) for k in requested])
+        missing = [k.replace('_', '/', 1) for k, e in zip(requested, entities) if e is None or e.team != g.team_key]
+        if missing:
+            return make_response(jsonify({'errors': ['short urls were not found: {}'.format(', '.join(missing))]}),
+                                 404)
+        key_names = requested
+    else:
+        return make_response(jsonify({'errors': ['tag or short_urls should be set']}), 400)
+    if len(key_names) > QR_EXPORT_MAX_SIZE:
+        return make_response(jsonify({'errors': ['up to {} short urls can be exported'.format(QR_EXPORT_MAX_SIZE)]}),
+                             400)
+    if not key_names:
+        return make_response(jsonify({'errors': ['no short url has the tag']}), 404)
+    export = QRExport(id=uuid.uuid4().hex, team=g.team_key, created_by=ndb.Key(User, team_user_id),
+                      short_urls=key_names, size=size, error_level=error_level, image_format=image_format)
+    export.put()
+    defer_qr_export(export.key.id())
+    return make_response(jsonify(qr_export_result(export)), 202)
+
+
+def get_team_qr_export(export_id):  # type: (str) -> QRExport
+    export = QRExport.get_by_id(export_id)
+    if export is None or export.team != g.team_key:
+        return None
+    return export
+
+
+@app.route('/api/v1/qr/exports/<export_id>', methods=['GET'])
+@team_id_required
+def qr_export(team_id, team_name, team_user_id, export_id):
+    export = get_team_qr_export(export_id)
+    if export is None:
+        return make_response(jsonify({'errors': ['the export was not found']}), 404)
+    return jsonify(qr_export_result(export))
+
+
+@app.route('/api/v1/qr/exports/<export_id>/download', methods=['GET'])
+@team_id_required
+def download_qr_export(team_id, team_name, team_user_id, export_id):
+    export = get_team_qr_export(export_id)
+    if export is None:
+        return make_response(jsonify({'errors': ['the export was not found']}), 404)
+    if export.status == 'failed':
+        return make_response(jsonify({'errors': ['the export failed, start a new export']}), 410)
+    if export.status != 'done':
+        return make_response(jsonify({'errors': ['the export is not finished yet']}), 409)
+
+    def generate():
+        with cloudstorage.open(export.object_name) as archive:
+            while True:
+                data = archive.read(QR_EXPORT_READ_SIZE)
+                if not data:
+                    return
+                yield data
+
+    response = Response(generate(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=qr-{}.zip'.format(export.key.id())
+    return response
 
-def generate_short_url_path(long_url):  # type: (str) -> str
-    KEY_BASE = "0123456789abcdefghijklmnopqrstuvwxyz"
-    BASE = 36
-    short_url_id = ShortURLID(long_url=long_url).put()
 
-    nid = short_url_id.id()
-    s = []
-    while nid:
-        nid, c = divmod(nid, BASE)
-        s.append(KEY_BASE[c])
-    s.reverse()
-    return "".join(s)
+def generate_short_url_paths(domains, reserved=()):  # type: (list, set) -> list
+    """
+    one generated path per domain, pool ids run sequentially and may reach a custom path,
+    so ids whose short url exists already or whose key name is in reserved are skipped
+    """
+    paths = [None] * len(domains)
+    pending = range(len(domains))
+    while pending:
+        candidates = [encode_id(nid, SHORT_URL_ALPHABET) for nid in short_url_id_pool.next_ids(len(pending))]
+        key_names = ["{}_{}".format(domains[i], path) for i, path in zip(pending, candidates)]
+        existing = ndb.get_multi([ndb.Key(ShortURL, k) for k in key_names])
+        taken = []
+        for i, path, key_name, short_url in zip(pending, candidates, key_names, existing):
+            if short_url is None and key_name not in reserved:
+                paths[i] = path
+            else:
+                taken.append(i)
+        pending = taken
+    return paths
+
+
+def generate_short_url_path(domain):  # type: (str) -> str
+    return generate_short_url_paths([domain])[0]
+
+
+def build_short_url(user_entity, form, path, generated_by_api):  # type: (User, LongURLForm, str, bool) -> ShortURL
+    """
+    short url with empty OGP data, filled in later by enrich_short_urls
+    """
+    return ShortURL(id="{}_{}".format(form.domain.data, path), long_url=form.url.data,
+                    short_url="{}/{}".format(form.domain.data, path),
+                    team=user_entity.team, updated_by=user_entity.key, created_by=user_entity.key,
+                    title='', description='', site_name='', image='',
+                    generated_by_api=generated_by_api, enrichment_status='pending'
+                    )
+
+
+def find_short_url(team_key, domain, long_url):  # type: (ndb.Key, str, str) -> ShortURL
+    """
+    existing short url of the team for the long url, None when it is not indexed or was deleted
+    """
+    index = LongURLIndex.get_by_id(LongURLIndex.index_id(team_key.id(), domain, long_url))
+    if index is None:
+        return None
+    short_url = index.short_url.get()
+    if short_url is None or short_url.team != team_key or short_url.long_url != long_url:
+        return None
+    return short_url
+
+
+def long_url_indexes(short_urls):  # type: (list) -> list
+    """
+    LongURLIndex entries to write for new short urls, entries pointing to a live short url of the page are kept
+    so dedup keeps returning the short url it returned before
+    """
+    indexes = {}
+    for short_url in short_urls:
+        entry = LongURLIndex.from_short_url(short_url)
+        indexes.setdefault(entry.key, (entry, short_url))
+    existing = [e for e in ndb.get_multi(indexes.keys()) if e is not None]
+    indexed = ndb.get_multi([e.short_url for e in existing])
+    live = set(e.key for e, s in zip(existing, indexed)
+               if s is not None and s.team == indexes[e.key][1].team and s.long_url == indexes[e.key][1].long_url)
+    return [new_index for key, (new_index, _) in indexes.items() if key not in live]
+
+
+def remove_from_long_url_index(short_url):  # type: (ShortURL) -> None
+    """
+    point the index entry of the deleted short url to another short url of the team for the page, or delete it
+    """
+    domain = short_url.key.id().split('_', 1)[0]
+    q = ShortURL.query(ShortURL.team == short_url.team, ShortURL.long_url == short_url.long_url)
+    # the query may still return the deleted short url
+    replacement = next((k for k in q.iter(keys_only=True)
+                        if k != short_url.key and k.id().split('_', 1)[0] == domain), None)
+    _replace_long_url_index(short_url, replacement)
+
+
+@ndb.transactional
+def _replace_long_url_index(short_url, replacement_key):  # type: (ShortURL, ndb.Key) -> None
+    index = LongURLIndex.from_short_url(short_url).key.get()
+    if index is None or index.short_url != short_url.key:
+        return
+    if replacement_key is None:
+        index.key.delete()
+    else:
+        index.short_url = replacement_key
+        index.put()
+
+
+@ndb.transactional(xg=True)
+def update_short_url_tags(short_url_key, updated_by, added=(), removed=(), memo=None):  # type: (...) -> ShortURL
+    """
+    change tags and memo of the short url, the team's TagSummary is updated in the same transaction
+    """
+    short_url = short_url_key.get()
+    old_tags = set(short_url.tags)
+    short_url.tags = (old_tags | set(added)) - set(removed)
+    if memo is not None:
+        short_url.memo = memo
+    short_url.updated_by = updated_by
+    entities = [short_url, Redirect.from_short_url(short_url)]
+    new_tags = set(short_url.tags)
+    if new_tags != old_tags:
+        summary = TagSummary.get_by_id(short_url.team.id()) or TagSummary(id=short_url.team.id())
+        summary.apply(old_tags - new_tags, new_tags - old_tags)
+        entities.append(summary)
+    ndb.put_multi(entities)
+    return short_url
+
+
+@ndb.transactional(xg=True)
+def delete_short_url(short_url_key):  # type: (ndb.Key) -> None
+    short_url = short_url_key.get()
+    if short_url is None:
+        return
+    ndb.delete_multi([short_url.key, ndb.Key(Redirect, short_url.key.id())])
+    if short_url.tags:
+        summary = TagSummary.get_by_id(short_url.team.id())
+        if summary is not None:
+            summary.apply(set(short_url.tags), set())
+            summary.put()
+
+
+def short_url_result(short_url):  # type: (ShortURL) -> dict
+    return {'short_url': short_url.short_url,
+            'title': short_url.title,
+            'long_url': short_url.long_url,
+            'description': short_url.description,
+            'image': short_url.image,
+            'created_at': short_url.created_at.strftime('%Y-%m-%d %H:%M:%S%Z'),
+            'id': short_url.key.id(),
+            'warning': short_url.enrichment_warning,
+            'enrichment_status': short_url.enrichment_status or 'done',
+            }
+
+
+def form_errors(form):  # type: (LongURLForm) -> list
+    errors = []
+    for field in form:
+        if len(field.errors) > 0:
+            for e in field.errors:
+                errors.append(e)
+    return errors
 
 
 @app.route('/api/v1/shorten', methods=['POST'])
 @team_id_required
 def shorten(team_id, team_name, team_user_id):
-    user_entity = User.get_by_id(team_user_id)
+    user_entity = current_user()
     json_data = request.get_json()
     form = LongURLForm.from_json(json_data)
     if form.validate():
         if form.custom_path.data is None or (form.custom_path.data) == 0:
-            path = generate_short_url_path(form.url.data)
+            if json_data.get('dedup', False) is True:
+                short_url = find_short_url(user_entity.team, form.domain.data, form.url.data)
+                if short_url is not None:
+                    return jsonify(dict(short_url_result(short_url), deduplicated=True))
+            path = generate_short_url_path(form.domain.data)
         else:
             path = form.custom_path.data.strip()
-        key_name = "{}_{}".format(form.domain.data, path)
-        try:
-            ogp = opengraph.OpenGraph(url=form.url.data)
-            warning = None
-        except HTTPError:
-            ogp = {'title': '', 'description': '', 'site_name': '', 'image': ''}
-            warning = 'cannot look up URL, is this right URL?'
-        except (KeyError, AttributeError):
-            ogp = {'title': '', 'description': '', 'site_name': '', 'image': ''}
-            warning = 'cannot parse OGP data'
-        short_url_string = "{}/{}".format(form.domain.data, path)
         if json_data.get('access_token', False):
             generated_by_api = True
         else:
             generated_by_api = False
-        short_url = ShortURL(id=key_name, long_url=form.url.data, short_url=short_url_string,
-                             team=user_entity.team, updated_by=user_entity.key, created_by=user_entity.key,
-                             title=ogp.get('title', ''), description=ogp.get('description', ''),
-                             site_name=ogp.get('site_name', ''), image=ogp.get('image', ''),
-                             generated_by_api=generated_by_api
-                             )
-        short_url.put()
-        result = {'short_url': short_url_string,
-                  'title': short_url.title,
-                  'long_url': short_url.long_url,
-                  'description': short_url.description,
-                  'image': short_url.image,
-                  'created_at': short_url.created_at.strftime('%Y-%m-%d %H:%M:%S%Z'),
-                  'id': short_url.key.id(),
-                  'warning': warning,
-                  }
-        return jsonify(result)
-    errors = []
-    for field in form:
-        if len(field.errors) > 0:
-            for e in field.errors:
-                errors.append(e)
-    return make_response(jsonify({'errors': errors}), 400)
+        short_url = build_short_url(user_entity, form, path, generated_by_api)
+        ndb.put_multi([short_url, Redirect.from_short_url(short_url)] + long_url_indexes([short_url]))
+        touch_short_urls(short_url.team.id())
+        register_short_url(short_url.key.id(), short_url.long_url)
+        index_short_urls([short_url])
+        defer_enrichment([short_url.key.id()])
+        return jsonify(dict(short_url_result(short_url), deduplicated=False))
+    return make_response(jsonify({'errors': form_errors(form)}), 400)
+
+
+@app.route('/api/v1/shorten/batch', methods=['POST'])
+@team_id_required
+def shorten_batch(team_id, team_name, team_user_id):
+    user_entity = current_user()
+    json_data = request.get_json()
+    items = json_data.get('urls')
+    if not isinstance(items, list) or len(items) == 0:
+        return make_response(jsonify({'errors': ['urls should be list of shorten request']}), 400)
+    if len(items) > SHORTEN_BATCH_MAX_SIZE:
+        return make_response(jsonify({'errors': ['urls should be less than {}'.format(SHORTEN_BATCH_MAX_SIZE + 1)]}),
+                             400)
+    results = [None] * len(items)
+    forms = {}
+    for i, item in enumerate(items):
+        form = BatchLongURLForm.from_json(item if isinstance(item, dict) else {})
+        if form.validate():
+            forms[i] = form
+        else:
+            results[i] = {'errors': form_errors(form)}
+    custom_paths = {}
+    for i, form in forms.items():
+        if form.custom_path.data:
+            key_name = "{}_{}".format(form.domain.data, form.custom_path.data.strip())
+            if key_name in custom_paths.values():
+                results[i] = {'errors': ['The short URL path is duplicated in the request']}
+            else:
+                custom_paths[i] = key_name
+    existing = ndb.get_multi([ndb.Key(ShortURL, k) for k in custom_paths.values()])
+    for (i, key_name), short_url in zip(custom_paths.items(), existing):
+        if short_url is not None:
+            results[i] = {'errors': ['The short URL path exists already']}
+    valid = sorted(i for i in forms if results[i] is None)
+    generated_by_api = bool(json_data.get('access_token', False))
+    generated = [i for i in valid if i not in custom_paths]
+    generated_paths = dict(zip(generated, generate_short_url_paths([forms[i].domain.data for i in generated],
+                                                                   set(custom_paths.values()))))
+    short_urls = []
+    for i in valid:
+        form = forms[i]
+        if i in custom_paths:
+            path = form.custom_path.data.strip()
+        else:
+            path = generated_paths[i]
+        short_urls.append(build_short_url(user_entity, form, path, generated_by_api))
+    if short_urls:
+        ndb.put_multi(short_urls + [Redirect.from_short_url(s) for s in short_urls] + long_url_indexes(short_urls))
+        touch_short_urls(user_entity.team.id())
+        register_short_urls({s.key.id(): s.long_url for s in short_urls})
+        index_short_urls(short_urls)
+        defer_enrichment([s.key.id() for s in short_urls])
+    for i, short_url in zip(valid, short_urls):
+        results[i] = short_url_result(short_url)
+    return jsonify({'results': results})
 
 
 @app.route('/api/v1/short_urls/<short_url_domain>/<short_url_path>', methods=['GET', 'PATCH'])
 @team_id_required
 def update_shorten_url(team_id, team_name, team_user_id, short_url_domain, short_url_path):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     short_url = ShortURL.get_by_id("{}_{}".format(short_url_domain, short_url_path))
     if short_url is None:
         return make_response(jsonify({'errors': ['the short url was not found']}), 404)
     if str(short_url.team.id()) != str(team_id):
         return make_response(jsonify({'errors': ['you can not update the short url']}), 400)
+    if request.method == 'GET':
+        result = {'short_url': '{}/{}'.format(short_url_domain, short_url_path), 'title': short_url.title,
+                  'long_url': short_url.long_url, 'description': short_url.description,
+                  'image': short_url.image, 'tags': short_url.tags, 'memo': short_url.memo,
+                  'count': get_click_count(short_url.key.id()),
+                  'enrichment_status': short_url.enrichment_status or 'done',
+                  'warning': short_url.enrichment_warning}
+        return jsonify(result)
     form = UpdateShortURLForm.from_json(request.get_json())
     if form.validate():
-        if form.tag.data is not None:
-            tags = short_url.tags
-            tags.append(form.tag.data)
-            short_url.tags = set(tags)
-        if form.memo.data is not None:
-            short_url.memo = form.memo.data
-        short_url.updated_by = user_entity.key
-        short_url.put()
+        added = [form.tag.data] if form.tag.data is not None else []
+        short_url = update_short_url_tags(short_url.key, user_entity.key, added=added, memo=form.memo.data)
+        touch_short_urls(short_url.team.id())
+        invalidate_short_url(short_url.key.id())
+        index_short_urls([short_url])
         result = {'short_url': '{}/{}'.format(short_url_domain, short_url_path), 'title': short_url.title,
                   'description': short_url.description,
                   'image': short_url.image, 'tags': short_url.tags, 'memo': short_url.memo}
@@ -425,18 +772,18 @@ def update_shorten_url(team_id, team_name, team_user_id, short_url_domain, short
 @app.route('/api/v1/short_urls/<short_url_domain>/<short_url_path>/tags/<tag>', methods=['DELETE'])
 @team_id_required
 def delete_shorten_url_tag(team_id, team_name, team_user_id, short_url_domain, short_url_path, tag):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    user_entity = current_user()
     short_url = ShortURL.get_by_id("{}_{}".format(short_url_domain, short_url_path))
     if short_url is None:
         return make_response(jsonify({'errors': ['the short url was not found']}), 404)
     if str(short_url.team.id()) != str(team_id):
         return make_response(jsonify({'errors': ['you can not update the short url']}), 400)
-    tags = short_url.tags
-    tags.remove(tag)
-    short_url.tags = set(tags)
-    short_url.updated_by = user_entity.key
-    short_url.put()
+    if tag not in short_url.tags:
+        return make_response(jsonify({'errors': ['the tag was not found']}), 404)
+    short_url = update_short_url_tags(short_url.key, user_entity.key, removed=[tag])
+    touch_short_urls(short_url.team.id())
+    invalidate_short_url(short_url.key.id())
+    index_short_urls([short_url])
     result = {'short_url': '{}/{}'.format(short_url_domain, short_url_path), 'title': short_url.title,
               'description': short_url.description,
               'image': short_url.image, 'tags': short_url.tags, 'memo': short_url.memo}
@@ -451,29 +798,88 @@ def delete_shorten_url(team_id, team_name, team_user_id, short_url_domain, short
         return make_response(jsonify({'errors': ['the short url was not found']}), 404)
     if str(short_url.team.id()) != str(team_id):
         return make_response(jsonify({'errors': ['you can not delete the short url']}), 400)
-    short_url.key.delete()
+    delete_short_url(short_url.key)
+    touch_short_urls(short_url.team.id())
+    remove_from_long_url_index(short_url)
+    unregister_short_url(short_url.key.id())
+    unindex_short_urls([short_url])
     return jsonify({'success': 'the url was deleted'})
 
 
+def short_url_list_item(e, count):  # type: (ShortURL, int) -> dict
+    return {'short_url': e.short_url,
+            'title': e.title,
+            'long_url': e.long_url,
+            'image': e.image,
+            'description': e.description,
+            'memo': e.memo,
+            'tags': e.tags,
+            'created_at': e.created_at.strftime('%Y-%m-%d %H:%M:%S%Z'),
+            'count': count,
+            'id': e.key.id()}
+
+
 @app.route('/api/v1/short_urls', methods=['GET'])
 @team_id_required
 def shorten_urls(team_id, team_name, team_user_id):
-    user_key_name = "{}_{}".format(team_id, users.get_current_user().user_id())
-    user_entity = User.get_by_id(user_key_name)
+    try:
+        limit = min(int(request.args.get('limit', LIST_PAGE_SIZE)), LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        return make_response(jsonify({'errors': ['limit should be number']}), 400)
+    tag = request.args.get('tag')
+    # click counts pending in memcache are not part of the version, a 304 may lag them by a flush interval
+    etag = hashlib.md5(u'{}:{}:{}:{}'.format(short_urls_version(g.team_key.id()), request.args.get('cursor'), limit,
+                                             tag).encode('utf-8')).hexdigest()
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
     q = ShortURL.query()
-    q = q.filter(ShortURL.team == user_entity.team).order(-ShortURL.created_at)
+    q = q.filter(ShortURL.team == g.team_key)
+    if tag:
+        q = q.filter(ShortURL.tags == tag)
+    q = q.order(-ShortURL.created_at)
     cursor = Cursor(urlsafe=request.args.get('cursor'))
-    entities, next_cursor, more = q.fetch_page(10, start_cursor=cursor)
-    results = [{'short_url': e.short_url,
-                'title': e.title,
-                'long_url': e.long_url,
-                'image': e.image,
-                'description': e.description,
-                'memo': e.memo,
-                'tags': e.tags,
-                'created_at': e.created_at.strftime('%Y-%m-%d %H:%M:%S%Z'),
-                'id': e.key.id()} for e in entities]
-    return jsonify({'results': results, 'next_cursor': next_cursor.urlsafe() if next_cursor else None, 'more': more})
+    keys, next_cursor, more = q.fetch_page(max(limit, 1), start_cursor=cursor, keys_only=True)
+    entities = [e for e in ndb.get_multi(keys) if e is not None]
+    click_counts = get_click_counts([e.key.id() for e in entities])
+    results = [short_url_list_item(e, click_counts[e.key.id()]) for e in entities]
+    response = jsonify({'results': results, 'next_cursor': next_cursor.urlsafe() if next_cursor else None,
+                        'more': more})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/v1/tags', methods=['GET'])
+@team_id_required
+def team_tags(team_id, team_name, team_user_id):
+    summary = TagSummary.get_by_id(g.team_key.id())
+    counts = summary.counts if summary is not None and summary.counts else {}
+    results = [{'tag': tag, 'count': count} for tag, count in sorted(counts.items(), key=lambda t: (-t[1], t[0]))]
+    return jsonify({'results': results})
+
+
+@app.route('/api/v1/search', methods=['GET'])
+@team_id_required
+def search_shorten_urls(team_id, team_name, team_user_id):
+    query = request.args.get('q', '').strip()
+    if not query:
+        return make_response(jsonify({'errors': ['q should not be empty']}), 400)
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return make_response(jsonify({'errors': ['limit should be number']}), 400)
+    try:
+        key_names, next_cursor = search_short_urls(g.team_key.id(), query, max(limit, 1), request.args.get('cursor'))
+    except ValueError:
+        return make_response(jsonify({'errors': ['cursor is invalid']}), 400)
+    # the index may lag behind deletes, entities decide what is returned
+    entities = [e for e in ndb.get_multi([ndb.Key(ShortURL, k) for k in key_names])
+                if e is not None and e.team == g.team_key]
+    click_counts = get_click_counts([e.key.id() for e in entities])
+    results = [short_url_list_item(e, click_counts[e.key.id()]) for e in entities]
+    return jsonify({'results': results, 'next_cursor': next_cursor, 'more': next_cursor is not None})
 
 
 @app.route('/api/v1/data/<short_url_domain>/<short_url_path>', methods=['GET'])
@@ -484,28 +890,28 @@ def data_short_url(team_id, team_name, team_user_id, short_url_domain, short_url
         return make_response(jsonify({'errors': ['data not found']}), 404)
     if str(short_url.team.id()) != str(team_id):
         return make_response(jsonify({'errors': ['you can not access to this data']}), 400)
-    q = Click.query()
-    q = q.filter(Click.short_url == short_url.key).order(Click.created_at)
-    clicks = q.fetch(1000)
-    results = [{
-        'referrer_medium': c.referrer_medium,
-        'location_country': c.location_country,
-        'user_agent_device': c.user_agent_device,
-        'user_agent_browser': c.user_agent_browser,
-        'short_url': c.short_url.id(),
-        'created_at': c.created_at.isoformat(),
-    } for c in clicks]
-    aggregated_dic = {}
-    for r in results:
-        date = r['created_at'][:10]
-        if date in aggregated_dic:
-            aggregated_dic[date].append(r)
-        else:
-            aggregated_dic[date] = [r]
-    aggregated = []
-    for key, value in aggregated_dic.iteritems():
-        aggregated.append({'date': key, 'data': value, 'count': len(value)})
-    return make_response(jsonify({'results': sorted(aggregated, key=lambda x: x['date'])}), 200)
+    try:
+        date_from = parse_date(request.args.get('from'))
+        date_to = parse_date(request.args.get('to'))
+    except ValueError:
+        return make_response(jsonify({'errors': ['from and to should be YYYY-MM-DD']}), 400)
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in ROLLUP_GRANULARITIES:
+        return make_response(jsonify({'errors': ['granularity should be day, week or month']}), 400)
+    try:
+        limit = min(int(request.args.get('limit', DATA_PAGE_SIZE)), DATA_MAX_PAGE_SIZE)
+    except ValueError:
+        return make_response(jsonify({'errors': ['limit should be number']}), 400)
+    q = ClickRollup.query()
+    q = q.filter(ClickRollup.short_url == short_url.key)
+    if date_from:
+        q = q.filter(ClickRollup.date >= date_from)
+    if date_to:
+        q = q.filter(ClickRollup.date <= date_to)
+    q = q.order(ClickRollup.date)
+    cursor = Cursor(urlsafe=request.args.get('cursor'))
+    return Response(stream_with_context(stream_rollups(q, granularity, max(limit, 1), cursor)),
+                    mimetype='application/json')
 
 
 @app.route('/page/terms', methods=['GET'])
@@ -524,21 +930,21 @@ def extract_short_url(short_url_path):
         host_name = 'jmpt.me'
     else:
         host_name = request.host
-    short_url = ShortURL.get_by_id("{}_{}".format(host_name, short_url_path))
-    if short_url is None:
+    key_name = "{}_{}".format(host_name, short_url_path)
+    long_url = get_long_url(key_name)
+    if long_url is None:
         response = make_response(render_template('404.html'), 404)
         return response
-    deferred.defer(write_click_log,
-                   short_url.key,
-                   request.referrer,
-                   request.remote_addr,
-                   request.headers.get('X-AppEngine-Country'),
-                   request.headers.get('X-AppEngine-Region'),
-                   request.headers.get('X-AppEngine-City'),
-                   request.headers.get('X-AppEngine-CityLatLong'),
-                   request.user_agent,
-                   request.args)
-    return redirect(short_url.long_url, code=302)
+    record_click(key_name,
+                 request.referrer,
+                 request.remote_addr,
+                 request.headers.get('X-AppEngine-Country'),
+                 request.headers.get('X-AppEngine-Region'),
+                 request.headers.get('X-AppEngine-City'),
+                 request.headers.get('X-AppEngine-CityLatLong'),
+                 request.user_agent,
+                 request.args)
+    return redirect(long_url, code=302)
 
 
 @app.errorhandler(404)
@@ -12,20 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
 import json
+import uuid
 import logging
+import datetime
 import unittest
+import zipfile
 import mock
+from StringIO import StringIO
+from urllib2 import HTTPError
 from urlparse import urlparse
 
-from google.appengine.api import users
+from google.appengine.api import users, memcache, apiproxy_stub_map, datastore_errors
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.ext import deferred
 from main import app
 from mock import patch
-from models import User, Team, ShortURL, Click, Invitation, APIToken
+from models import User, Team, ShortURL, Click, Invitation, APIToken, Redirect, ClickCounterShard, ClickRollup, \
+    OGPMetadata, LongURLIndex, TagSummary
+from cache import short_url_cache, get_long_url, rebuild_path_filters, counter, flush_path_filters, \
+    PATH_FILTER_QUEUE_NAME
+from tasks import backfill_redirects, build_click, parse_user_agent, parse_referrer, user_agent_cache, referrer_cache, \
+    ensure_click_log_table, provision_click_log_tables, known_click_log_tables, click_log_sink, \
+    backfill_long_url_index, deliver_invitations, InvitationDeliveryError, rebuild_tag_summary, build_qr_export, \
+    backfill_api_tokens
+from ingestion import InMemoryClickBuffer, flush_clicks
+from bqsink import BigQuerySink, FakeBigQueryClient
+from counters import increment_click_count, flush_click_count, get_click_count
+from rollups import backfill_click_rollups, rollup_id, apply_rollup_deltas, aggregate_clicks
+from idpool import IDPool, LocalIDAllocator, encode_id, BASE62_ALPHABET
+from workers import scheduled_intervals
+from ogp import get_ogp
+from auth import validate_team_user, team_user_cache, hash_token, migrate_legacy_token
+from mailer import FakeMailTransport
+from fulltext import InvertedIndex
+
+
+def run_deferred_tasks(taskqueue_stub, queue_name='default'):
+    tasks = taskqueue_stub.get_filtered_tasks(queue_names=queue_name)
+    taskqueue_stub.FlushQueue(queue_name)
+    for task in tasks:
+        deferred.run(task.payload)
 
 
 class MainHandlerTest(unittest.TestCase):
@@ -93,6 +123,8 @@ class ShortenHandlerTest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path='.')
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
         self.testbed.setup_env(
             user_email='example@example.com',
             user_id='1234567890',
@@ -137,6 +169,8 @@ class ShortenHandlerTest(unittest.TestCase):
                                  content_type='application/json',
                                  follow_redirects=False)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['enrichment_status'], 'pending')
+        run_deferred_tasks(self.taskqueue_stub)
         short_urls = ShortURL.query().fetch(1000)
         self.assertEqual(short_urls[0].long_url, 'http://github.com')
         self.assertEqual(short_urls[0].created_by, User.get_by_id(self.user_id).key)
@@ -147,6 +181,7 @@ class ShortenHandlerTest(unittest.TestCase):
                          'https://assets-cdn.github.com/images/modules/open_graph/github-logo.png')
         self.assertEqual(short_urls[0].site_name, 'GitHub')
         self.assertEqual(short_urls[0].description, 'GitHub is where people build software')
+        self.assertEqual(short_urls[0].enrichment_status, 'done')
         bad_request = self.app.post('/api/v1/shorten',
                                     data=json.dumps({'url': 'hoge.hage', 'domain': 'jmpt.me'}),
                                     content_type='application/json',
@@ -215,11 +250,242 @@ class ShortenHandlerTest(unittest.TestCase):
         response_detail = self.app.get('/page/detail/jmpt.me/jmptme1',
                                        headers={'Host': 'jmpt.me'})
         self.assertEqual(response_detail.status_code, 200)
+        # the chart asks for the latest days instead of the oldest page
+        chart_from = datetime.datetime.utcnow().date() - datetime.timedelta(days=89)
+        self.assertIn("'from': '{}'".format(chart_from.strftime('%Y-%m-%d')), response_detail.data)
         response_image = self.app.get('/image/qr/jmpt.me/jmptme1',
                                       headers={'Host': 'jmpt.me'})
         self.assertEqual(response_image.status_code, 200)
         self.assertEqual(response_image.headers['Content-type'], 'image/png')
 
+    @patch('opengraph.OpenGraph')
+    def testQRCode(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.post('/api/v1/shorten',
+                      data=json.dumps({'url': 'https://github.com', 'domain': 'jmpt.me', 'custom_path': 'gh'}),
+                      content_type='application/json', follow_redirects=False)
+        renders = counter('qr.renders')
+        response = self.app.get('/image/qr/jmpt.me/gh?format=svg&size=4&level=h', follow_redirects=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/svg+xml')
+        self.assertTrue('<svg' in response.data)
+        self.assertTrue('max-age=' in response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        cached = self.app.get('/image/qr/jmpt.me/gh?format=svg&size=4&level=H', follow_redirects=False)
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(counter('qr.renders'), renders + 1)
+        not_modified = self.app.get('/image/qr/jmpt.me/gh?format=svg&size=4&level=H', headers={'If-None-Match': etag},
+                                    follow_redirects=False)
+        self.assertEqual(not_modified.status_code, 304)
+        png = self.app.get('/image/qr/jmpt.me/gh', headers={'If-None-Match': etag}, follow_redirects=False)
+        self.assertEqual(png.status_code, 200)
+        self.assertEqual(png.mimetype, 'image/png')
+        self.assertNotEqual(png.headers['ETag'], etag)
+        self.assertEqual(self.app.get('/image/qr/jmpt.me/gh?size=100', follow_redirects=False).status_code, 400)
+        self.assertEqual(self.app.get('/image/qr/jmpt.me/gh?format=gif', follow_redirects=False).status_code, 400)
+        self.assertEqual(self.app.get('/image/qr/jmpt.me/missing', follow_redirects=False).status_code, 404)
+
+    @patch('opengraph.OpenGraph')
+    def testQRExport(self, OpenGraph):
+        # cloudstorage keeps objects in the blobstore stub in tests
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_blobstore_stub()
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        for path in ('gh1', 'gh2', 'gh3'):
+            self.app.post('/api/v1/shorten',
+                          data=json.dumps({'url': 'https://github.com/{}'.format(path), 'domain': 'jmpt.me',
+                                           'custom_path': path}),
+                          content_type='application/json', follow_redirects=False)
+        for path in ('gh1', 'gh3'):
+            self.app.patch('/api/v1/short_urls/jmpt.me/{}'.format(path), data=json.dumps({'tag': 'print'}),
+                           content_type='application/json', follow_redirects=False)
+
+        def post(payload):
+            return self.app.post('/api/v1/qr/exports', data=json.dumps(payload), content_type='application/json',
+                                 follow_redirects=False)
+
+        self.assertEqual(post({'short_urls': ['jmpt.me/gh1', 'jmpt.me/none']}).status_code, 404)
+        self.assertEqual(post({'tag': 'print', 'format': 'gif'}).status_code, 400)
+        self.assertEqual(post({}).status_code, 400)
+        response = post({'tag': 'print', 'format': 'svg', 'size': 4})
+        self.assertEqual(response.status_code, 202)
+        export = json.loads(response.data)
+        self.assertEqual(export['status'], 'pending')
+        self.assertEqual(export['count'], 2)
+        self.assertEqual(self.app.get('/api/v1/qr/exports/{}/download'.format(export['id'])).status_code, 409)
+        run_deferred_tasks(self.taskqueue_stub)
+        status = json.loads(self.app.get('/api/v1/qr/exports/{}'.format(export['id'])).data)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['failed'], [])
+        download = self.app.get(status['download_url'], follow_redirects=False)
+        self.assertEqual(download.mimetype, 'application/zip')
+        archive = zipfile.ZipFile(StringIO(download.data))
+        self.assertEqual(sorted(archive.namelist()), ['jmpt.me/gh1.svg', 'jmpt.me/gh3.svg'])
+        self.assertTrue('<svg' in archive.read('jmpt.me/gh1.svg'))
+        listed = json.loads(post({'short_urls': ['jmpt.me/gh2', 'jmpt.me/gh2']}).data)
+        self.assertEqual(listed['count'], 1)
+        # failures are retried by the task queue, the last retry marks the export failed
+        with patch('tasks.write_qr_zip', side_effect=ValueError('broken')):
+            self.assertRaises(ValueError, build_qr_export, listed['id'])
+            self.assertEqual(json.loads(self.app.get('/api/v1/qr/exports/{}'.format(listed['id'])).data)['status'],
+                             'pending')
+            with patch.dict('os.environ', {'HTTP_X_APPENGINE_TASKRETRYCOUNT': '3'}):
+                build_qr_export(listed['id'])
+        status = json.loads(self.app.get('/api/v1/qr/exports/{}'.format(listed['id'])).data)
+        self.assertEqual(status['status'], 'failed')
+        self.assertIsNone(status['download_url'])
+        self.assertEqual(self.app.get('/api/v1/qr/exports/{}/download'.format(listed['id'])).status_code, 410)
+
+    def testDeletedUser(self):
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.assertEqual(self.app.get('/api/v1/short_urls', follow_redirects=False).status_code, 200)
+        # the validation is cached, the handler finds the user deleted
+        ndb.Key(User, self.user_id).delete()
+        response = self.app.post('/api/v1/shorten',
+                                 data=json.dumps({'url': 'https://github.com', 'domain': 'jmpt.me'}),
+                                 content_type='application/json', follow_redirects=False)
+        self.assertEqual(response.status_code, 401)
+
+    @patch('opengraph.OpenGraph')
+    def testGeneratedPathSkipsCustomPath(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+
+        def post(url, payload):
+            response = self.app.post(url, data=json.dumps(payload), content_type='application/json',
+                                     follow_redirects=False)
+            return json.loads(response.data)
+
+        with patch('main.short_url_id_pool', IDPool(LocalIDAllocator(start=int('gh', 36)))):
+            post('/api/v1/shorten', {'url': 'https://github.com/custom', 'domain': 'jmpt.me', 'custom_path': 'gh'})
+            self.assertEqual(post('/api/v1/shorten', {'url': 'https://github.com/1', 'domain': 'jmpt.me'})['short_url'],
+                             'jmpt.me/gi')
+            results = post('/api/v1/shorten/batch', {'urls': [
+                {'url': 'https://github.com/2', 'domain': 'jmpt.me', 'custom_path': 'gk'},
+                {'url': 'https://github.com/3', 'domain': 'jmpt.me'},
+                {'url': 'https://github.com/4', 'domain': 'jmpt.me'},
+            ]})['results']
+            self.assertEqual([r['short_url'] for r in results], ['jmpt.me/gk', 'jmpt.me/gj', 'jmpt.me/gl'])
+        self.assertEqual(ShortURL.get_by_id('jmpt.me_gh').long_url, 'https://github.com/custom')
+        self.assertEqual(Redirect.get_by_id('jmpt.me_gh').long_url, 'https://github.com/custom')
+        self.assertEqual(ShortURL.get_by_id('jmpt.me_gk').long_url, 'https://github.com/2')
+
+    @patch('opengraph.OpenGraph')
+    def testShortenBatch(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': 'GitHub is where people build software',
+                                  'site_name': 'GitHub', 'image': ''}
+        ShortURL(id='jmpt.me_exists', long_url='https://github.com', short_url='jmpt.me/exists',
+                 team=ndb.Key(Team, self.team_id)).put()
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        response = self.app.post('/api/v1/shorten/batch',
+                                 data=json.dumps({'urls': [
+                                     {'url': 'https://github.com/1', 'domain': 'jmpt.me'},
+                                     {'url': 'hoge.hage', 'domain': 'jmpt.me'},
+                                     {'url': 'https://github.com/2', 'domain': 'jmpt.me', 'custom_path': 'batch'},
+                                     {'url': 'https://github.com/3', 'domain': 'jmpt.me', 'custom_path': 'batch'},
+                                     {'url': 'https://github.com/4', 'domain': 'jmpt.me', 'custom_path': 'exists'},
+                                     {'url': 'https://github.com/5', 'domain': 'jmpt.me'},
+                                 ]}),
+                                 content_type='application/json',
+                                 follow_redirects=False)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0]['enrichment_status'], 'pending')
+        self.assertEqual(results[1]['errors'], ['String posted was not valid URL'])
+        self.assertEqual(results[2]['short_url'], 'jmpt.me/batch')
+        self.assertEqual(results[3]['errors'], ['The short URL path is duplicated in the request'])
+        self.assertEqual(results[4]['errors'], ['The short URL path exists already'])
+        self.assertNotEqual(results[0]['short_url'], results[5]['short_url'])
+        self.assertEqual(len(ShortURL.query().fetch(1000)), 4)
+        self.assertEqual(len(Redirect.query().fetch(1000)), 3)
+        self.assertEqual(get_long_url('jmpt.me_batch'), 'https://github.com/2')
+        run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(ShortURL.get_by_id('jmpt.me_batch').title, 'GitHub')
+        bad_response = self.app.post('/api/v1/shorten/batch',
+                                     data=json.dumps({'urls': 'https://github.com'}),
+                                     content_type='application/json',
+                                     follow_redirects=False)
+        self.assertEqual(bad_response.status_code, 400)
+
+    @patch('opengraph.OpenGraph')
+    def testEnrichmentFailure(self, OpenGraph):
+        OpenGraph.side_effect = HTTPError('http://github.com/404', 404, 'Not Found', {}, None)
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.post('/api/v1/shorten',
+                      data=json.dumps({'url': 'http://github.com/404', 'domain': 'jmpt.me', 'custom_path': 'notfound'}),
+                      content_type='application/json',
+                      follow_redirects=False)
+        run_deferred_tasks(self.taskqueue_stub)
+        response = self.app.get('/api/v1/short_urls/jmpt.me/notfound', follow_redirects=False)
+        self.assertEqual(json.loads(response.data)['enrichment_status'], 'failed')
+        self.assertEqual(json.loads(response.data)['warning'], 'cannot look up URL, is this right URL?')
+        self.assertEqual(json.loads(response.data)['title'], '')
+
+    @patch('opengraph.OpenGraph')
+    def testOGPCache(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        for url in ['https://GitHub.com/search?q=a&type=code', 'https://github.com/search?type=code&q=a#top']:
+            self.app.post('/api/v1/shorten',
+                          data=json.dumps({'url': url, 'domain': 'jmpt.me'}),
+                          content_type='application/json',
+                          follow_redirects=False)
+            run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(OpenGraph.call_count, 1)
+        self.assertEqual([s.title for s in ShortURL.query().fetch(1000)], ['GitHub', 'GitHub'])
+        self.assertEqual(len(OGPMetadata.query().fetch(1000)), 1)
+        memcache.flush_all()
+        self.assertEqual(get_ogp('https://github.com/search?q=a&type=code')[0]['title'], 'GitHub')
+        self.assertEqual(OpenGraph.call_count, 1)
+        OpenGraph.side_effect = HTTPError('http://github.com/404', 404, 'Not Found', {}, None)
+        self.assertEqual(get_ogp('http://github.com/404')[1], 'cannot look up URL, is this right URL?')
+        self.assertEqual(get_ogp('http://github.com/404')[1], 'cannot look up URL, is this right URL?')
+        self.assertEqual(OpenGraph.call_count, 2)
+
+    @patch('opengraph.OpenGraph')
+    def testDedup(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+
+        def post(payload):
+            response = self.app.post('/api/v1/shorten', data=json.dumps(payload),
+                                     content_type='application/json', follow_redirects=False)
+            return json.loads(response.data)
+
+        first = post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})
+        self.assertEqual(first['deduplicated'], False)
+        second = post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})
+        self.assertEqual(second['deduplicated'], True)
+        self.assertEqual(second['short_url'], first['short_url'])
+        plain = post({'url': 'https://github.com', 'domain': 'jmpt.me'})
+        self.assertNotEqual(plain['short_url'], first['short_url'])
+        self.assertNotEqual(post({'url': 'https://github.com', 'domain': 'jmpt.me', 'custom_path': 'gh',
+                                  'dedup': True})['short_url'], first['short_url'])
+        # new short urls of the page do not take over the index entry
+        third = post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})
+        self.assertEqual(third['short_url'], first['short_url'])
+        self.app.delete('/api/v1/short_urls/jmpt.me/gh')
+        self.assertEqual(post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})['short_url'],
+                         first['short_url'])
+        # the entry moves to a remaining short url of the page when the indexed one is deleted
+        self.app.delete('/api/v1/short_urls/{}'.format(first['short_url']))
+        fourth = post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})
+        self.assertEqual(fourth['deduplicated'], True)
+        self.assertEqual(fourth['short_url'], plain['short_url'])
+        self.app.delete('/api/v1/short_urls/{}'.format(plain['short_url']))
+        self.assertEqual(post({'url': 'https://github.com', 'domain': 'jmpt.me', 'dedup': True})['deduplicated'], False)
+        ShortURL(id='jmpt.me_old', long_url='https://github.com/old', short_url='jmpt.me/old',
+                 team=ndb.Key(Team, self.team_id)).put()
+        self.assertEqual(post({'url': 'https://github.com/old', 'domain': 'jmpt.me', 'dedup': True})['deduplicated'],
+                         False)
+        LongURLIndex.query().fetch(1000)[0].key.delete()
+        backfill_long_url_index()
+        self.assertEqual(len(LongURLIndex.query().fetch(1000)), 2)
+
     @patch('opengraph.OpenGraph')
     def testPatch(self, OpenGraph):
         OpenGraph.return_value = {'title': 'GitHub', 'description': 'GitHub is where people build software',
@@ -276,6 +542,95 @@ class ShortenHandlerTest(unittest.TestCase):
         self.assertEqual(delete_response.status_code, 200)
         self.assertEqual(json.loads(delete_response.data)['success'], 'the url was deleted')
 
+    @patch('opengraph.OpenGraph')
+    def testSearch(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': 'GitHub is where people build software',
+                                  'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        with patch('fulltext.search_index', InvertedIndex()):
+            for path in ('gh1', 'gh2', 'gh3'):
+                self.app.post('/api/v1/shorten',
+                              data=json.dumps({'url': 'https://github.com/{}'.format(path), 'domain': 'jmpt.me',
+                                               'custom_path': path}),
+                              content_type='application/json', follow_redirects=False)
+
+            def search(query, **params):
+                response = self.app.get('/api/v1/search', query_string=dict(params, q=query), follow_redirects=False)
+                return json.loads(response.data)
+
+            self.assertEqual(len(search('github')['results']), 3)
+            self.assertEqual(search('people')['results'], [])
+            run_deferred_tasks(self.taskqueue_stub)
+            self.assertEqual(len(search('People build')['results']), 3)
+            first_page = search('github', limit=2)
+            self.assertEqual(len(first_page['results']), 2)
+            self.assertEqual(first_page['more'], True)
+            second_page = search('github', limit=2, cursor=first_page['next_cursor'])
+            self.assertEqual(len(second_page['results']), 1)
+            self.assertEqual(second_page['more'], False)
+            self.app.patch('/api/v1/short_urls/jmpt.me/gh2', data=json.dumps({'tag': 'release', 'memo': 'launch'}),
+                           content_type='application/json', follow_redirects=False)
+            self.assertEqual([r['short_url'] for r in search('release launch')['results']], ['jmpt.me/gh2'])
+            self.app.delete('/api/v1/short_urls/jmpt.me/gh2/tags/release')
+            self.assertEqual(search('release')['results'], [])
+            self.app.delete('/api/v1/short_urls/jmpt.me/gh1')
+            self.assertEqual(set(r['short_url'] for r in search('github')['results']), {'jmpt.me/gh2', 'jmpt.me/gh3'})
+            self.assertEqual(self.app.get('/api/v1/search', follow_redirects=False).status_code, 400)
+
+    @patch('opengraph.OpenGraph')
+    def testTags(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        for path in ('gh1', 'gh2', 'gh3'):
+            self.app.post('/api/v1/shorten',
+                          data=json.dumps({'url': 'https://github.com/{}'.format(path), 'domain': 'jmpt.me',
+                                           'custom_path': path}),
+                          content_type='application/json', follow_redirects=False)
+
+        def add_tag(path, tag):
+            self.app.patch('/api/v1/short_urls/jmpt.me/{}'.format(path), data=json.dumps({'tag': tag}),
+                           content_type='application/json', follow_redirects=False)
+
+        def tag_counts():
+            response = self.app.get('/api/v1/tags', follow_redirects=False)
+            return [(r['tag'], r['count']) for r in json.loads(response.data)['results']]
+
+        self.assertEqual(tag_counts(), [])
+        add_tag('gh1', 'blog')
+        add_tag('gh2', 'blog')
+        add_tag('gh2', 'blog')
+        add_tag('gh2', 'news')
+        add_tag('gh3', 'ads')
+        self.assertEqual(tag_counts(), [('blog', 2), ('ads', 1), ('news', 1)])
+        response = self.app.get('/api/v1/short_urls?tag=blog', follow_redirects=False)
+        self.assertEqual(set(r['short_url'] for r in json.loads(response.data)['results']),
+                         {'jmpt.me/gh1', 'jmpt.me/gh2'})
+        self.app.delete('/api/v1/short_urls/jmpt.me/gh2/tags/news')
+        self.assertEqual(self.app.delete('/api/v1/short_urls/jmpt.me/gh2/tags/news').status_code, 404)
+        self.app.delete('/api/v1/short_urls/jmpt.me/gh1')
+        self.assertEqual(tag_counts(), [('ads', 1), ('blog', 1)])
+        TagSummary.get_by_id(self.team_id).key.delete()
+        rebuild_tag_summary(self.team_id)
+        self.assertEqual(tag_counts(), [('ads', 1), ('blog', 1)])
+
+
+class InvertedIndexTest(unittest.TestCase):
+    def testSearch(self):
+        index = InvertedIndex()
+        document = {'id': 'jmpt.me_a', 'team_id': 1, 'rank': 2, 'title': u'Release notes', 'description': u'',
+                    'site_name': u'GitHub', 'long_url': u'https://github.com/releases', 'memo': u'', 'tags': [u'v1']}
+        index.put([document, dict(document, id='jmpt.me_b', rank=1, tags=[]),
+                   dict(document, id='jmpt.me_c', team_id=2)])
+        self.assertEqual(index.search(1, u'github RELEASE', 10), (['jmpt.me_a', 'jmpt.me_b'], None))
+        self.assertEqual(index.search(1, u'release', 1), (['jmpt.me_a'], '1'))
+        self.assertEqual(index.search(1, u'release', 1, '1'), (['jmpt.me_b'], None))
+        self.assertEqual(index.search(1, u'v1', 10), (['jmpt.me_a'], None))
+        index.put([dict(document, title=u'Changelog', tags=[])])
+        self.assertEqual(index.search(1, u'notes', 10), (['jmpt.me_b'], None))
+        index.delete(1, ['jmpt.me_b'])
+        self.assertEqual(index.search(1, u'notes', 10), ([], None))
+        self.assertEqual(index.search(2, u'notes', 10), (['jmpt.me_c'], None))
+
 
 class ShortenByAPIHandlerTest(unittest.TestCase):
     def setUp(self):
@@ -284,6 +639,8 @@ class ShortenByAPIHandlerTest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path='.')
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
         self.testbed.setup_env(
             user_email='example@example.com',
             user_id='1234567890',
@@ -321,17 +678,10 @@ class ShortenByAPIHandlerTest(unittest.TestCase):
                                        follow_redirects=False)
         self.assertEquals(token_response.status_code, 302)
         self.assertEquals(token_response.location.endswith('/page/settings'), True)
-        team_users = User.query().filter(User.team == Team.get_by_id(int(self.team_id)).key).order(
-            -Team.created_at).fetch()
-        team_user_dic = {u.key.id(): u.user_name for u in team_users}
-        qo = ndb.QueryOptions(keys_only=True)
-        api_token_query = APIToken.query().filter(APIToken.team == Team.get_by_id(int(self.team_id)).key).order(
-            -APIToken.created_at).fetch(1000, options=qo)
-        api_token_query_results = ndb.get_multi(api_token_query)
-        api_tokens = [
-            {'token': t.key.id(), 'created_by': team_user_dic[t.created_by.id()], 'created_at': str(t.created_at)}
-            for t in api_token_query_results if t is not None]
-        access_token = api_tokens[0]['token']
+        settings_response = self.app.get('/page/settings', follow_redirects=False)
+        access_token = re.search(r'<code>([0-9a-f]{32})</code>', settings_response.data).group(1)
+        self.assertEqual(APIToken.query().fetch(1000)[0].key.id(), hash_token(access_token))
+        self.assertEqual(re.search(r'<code>', self.app.get('/page/settings', follow_redirects=False).data), None)
         api_client = app.test_client()
         response = api_client.post('/api/v1/shorten',
                                    data=json.dumps(
@@ -339,6 +689,8 @@ class ShortenByAPIHandlerTest(unittest.TestCase):
                                    content_type='application/json',
                                    follow_redirects=False)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['enrichment_status'], 'pending')
+        run_deferred_tasks(self.taskqueue_stub)
         short_urls = ShortURL.query().fetch(1000)
         self.assertEqual(short_urls[0].long_url, 'http://github.com')
         self.assertEqual(short_urls[0].created_by, User.get_by_id(self.user_id).key)
@@ -351,6 +703,75 @@ class ShortenByAPIHandlerTest(unittest.TestCase):
         self.assertEqual(short_urls[0].description, 'GitHub is where people build software')
         self.assertEqual(short_urls[0].generated_by_api, True)
 
+    def post_with_token(self, access_token):
+        return app.test_client().post('/api/v1/shorten',
+                                      data=json.dumps({'url': 'http://github.com', 'domain': 'jmpt.me',
+                                                       'access_token': access_token}),
+                                      content_type='application/json',
+                                      follow_redirects=False)
+
+    @patch('opengraph.OpenGraph')
+    def testRevokeToken(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.post('/page/token', follow_redirects=False)
+        settings_response = self.app.get('/page/settings', follow_redirects=False)
+        access_token = re.search(r'<code>([0-9a-f]{32})</code>', settings_response.data).group(1)
+        self.assertEqual(self.post_with_token(access_token).status_code, 200)
+        revoke_response = self.app.post('/page/revoke/token/{}'.format(hash_token(access_token)),
+                                        follow_redirects=False)
+        self.assertEqual(revoke_response.status_code, 302)
+        response = self.post_with_token(access_token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.data)['errors'], ['bad request, the access token was revoked'])
+        self.assertEqual(self.post_with_token('unknown').status_code, 401)
+
+    @patch('opengraph.OpenGraph')
+    def testLegacyToken(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        legacy_token = uuid.uuid4().hex
+        APIToken(id=legacy_token, team=ndb.Key(Team, self.team_id), created_by=ndb.Key(User, self.user_id)).put()
+        self.assertEqual(self.post_with_token(legacy_token).status_code, 200)
+        self.assertEqual([t.key.id() for t in APIToken.query().fetch(1000)], [hash_token(legacy_token)])
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.post('/page/delete/token/{}'.format(hash_token(legacy_token)), follow_redirects=False)
+        self.assertEqual(self.post_with_token(legacy_token).status_code, 401)
+
+    @patch('opengraph.OpenGraph')
+    def testTokenLookups(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        unknown_token = uuid.uuid4().hex
+        self.assertEqual(self.post_with_token(unknown_token).status_code, 401)
+        with patch('auth.APIToken.get_by_id') as get_by_id:
+            self.assertEqual(self.post_with_token(unknown_token).status_code, 401)
+            self.assertEqual(get_by_id.call_count, 0)
+        legacy_token = uuid.uuid4().hex
+        APIToken(id=legacy_token, team=ndb.Key(Team, self.team_id), created_by=ndb.Key(User, self.user_id)).put()
+
+        def migrated_concurrently(token):
+            migrate_legacy_token(token)
+            return None
+
+        # the request losing the migration race finds the token under its hash
+        with patch('auth.migrate_legacy_token', side_effect=migrated_concurrently):
+            self.assertEqual(self.post_with_token(legacy_token).status_code, 200)
+
+    @patch('opengraph.OpenGraph')
+    def testBackfillAPITokens(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        legacy_tokens = [uuid.uuid4().hex for _ in range(3)]
+        for token in legacy_tokens:
+            APIToken(id=token, team=ndb.Key(Team, self.team_id), created_by=ndb.Key(User, self.user_id)).put()
+        hashed = APIToken(id=hash_token('hashed'), team=ndb.Key(Team, self.team_id)).put()
+        with patch('tasks.BACKFILL_BATCH_SIZE', 2):
+            backfill_api_tokens()
+            while self.taskqueue_stub.get_filtered_tasks(queue_names='default'):
+                run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(sorted(k.id() for k in APIToken.query().fetch(1000, keys_only=True)),
+                         sorted([hash_token(t) for t in legacy_tokens] + [hashed.id()]))
+        self.assertEqual(APIToken.get_by_id(hash_token(legacy_tokens[0])).hint, legacy_tokens[0][-4:])
+        self.assertEqual(self.post_with_token(legacy_tokens[0]).status_code, 200)
+
 
 class ShortURLsAPITest(unittest.TestCase):
     def setUp(self):
@@ -359,6 +780,7 @@ class ShortURLsAPITest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path='.')
         self.testbed.setup_env(
             user_email='example@example.com',
             user_id='1234567890',
@@ -426,6 +848,46 @@ class ShortURLsAPITest(unittest.TestCase):
                                      follow_redirects=False)
         self.assertEqual(json.loads(next_response.data)['results'][0]['short_url'], 'jmpt.me/011')
 
+    def testETag(self):
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key, title='test title').put()
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        response = self.app.get('/api/v1/short_urls?limit=1', follow_redirects=False)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        not_modified = self.app.get('/api/v1/short_urls?limit=1', headers={'If-None-Match': etag},
+                                    follow_redirects=False)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, '')
+        other_limit = self.app.get('/api/v1/short_urls?limit=2', headers={'If-None-Match': etag},
+                                   follow_redirects=False)
+        self.assertEqual(other_limit.status_code, 200)
+        self.app.post('/api/v1/shorten', data=json.dumps({'url': 'https://github.com', 'domain': 'jmpt.me',
+                                                          'custom_path': '02'}),
+                      content_type='application/json', follow_redirects=False)
+        modified = self.app.get('/api/v1/short_urls?limit=1', headers={'If-None-Match': etag},
+                                follow_redirects=False)
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(json.loads(modified.data)['results'][0]['short_url'], 'jmpt.me/02')
+        self.assertEqual(len(json.loads(modified.data)['results']), 1)
+        self.app.delete('/api/v1/short_urls/jmpt.me/02')
+        deleted = self.app.get('/api/v1/short_urls?limit=1', headers={'If-None-Match': modified.headers['ETag']},
+                               follow_redirects=False)
+        self.assertEqual(deleted.status_code, 200)
+        self.assertEqual(json.loads(deleted.data)['results'][0]['short_url'], 'jmpt.me/01')
+        etag = deleted.headers['ETag']
+        # pending clicks do not change the ETag, their flush does
+        increment_click_count('jmpt.me_01')
+        with patch('main.ShortURL.query') as query:
+            not_modified = self.app.get('/api/v1/short_urls?limit=1', headers={'If-None-Match': etag},
+                                        follow_redirects=False)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(query.call_count, 0)
+        flush_click_count('jmpt.me_01')
+        counted = self.app.get('/api/v1/short_urls?limit=1', headers={'If-None-Match': etag}, follow_redirects=False)
+        self.assertEqual(counted.status_code, 200)
+        self.assertEqual(json.loads(counted.data)['results'][0]['count'], 1)
+
 
 class RedirectLoggingTest(unittest.TestCase):
     def setUp(self):
@@ -443,6 +905,8 @@ class RedirectLoggingTest(unittest.TestCase):
             overwrite=True)
         self.app = app.test_client()
         ndb.get_context().clear_cache()
+        short_url_cache.clear()
+        scheduled_intervals.clear()
         new_team = Team(team_name='hoge', billing_plan='trial',
                         team_domain='ysk')
         new_team_key = new_team.put()
@@ -504,12 +968,364 @@ class RedirectLoggingTest(unittest.TestCase):
         self.assertEquals(click_results[0].referrer, 'https://www.google.co.jp/search')
         self.assertEquals(click_results[0].referrer_name, 'Google')
         self.assertEquals(click_results[0].referrer_medium, 'search')
+        # clicks go to the rollups and BigQuery by one task per interval
+        self.assertEqual(ClickRollup.query().count(), 0)
+        interval_tasks = [t for t in self.taskqueue_stub.get_filtered_tasks() if t.name.startswith('click-interval-')]
+        self.assertEqual(len(interval_tasks), 1)
+        client = FakeBigQueryClient()
+        click_log_sink.reset_client(client)
+        try:
+            # a retried task neither counts nor inserts the clicks again
+            deferred.run(interval_tasks[0].payload)
+            deferred.run(interval_tasks[0].payload)
+        finally:
+            click_log_sink.reset_client()
+            known_click_log_tables.clear()
+        self.assertEqual([r['id'] for rows in client.tables.values() for r in rows], [click_results[0].key.id()])
         self.app.set_cookie('localhost', 'team', str(self.team_id))
         api_response = self.app.get('/api/v1/data/jmpt.me/01',
                                     follow_redirects=False,
                                     headers={'Host': 'jmpt.me'})
         self.assertEqual(api_response.status_code, 200)
-        self.assertEqual(json.loads(api_response.data)['results'][0]['data'][0]['referrer_medium'], 'search')
+        self.assertEqual(json.loads(api_response.data)['results'][0]['count'], 1)
+        self.assertEqual(json.loads(api_response.data)['results'][0]['referrer_medium'], {'search': 1})
+        self.assertEqual(json.loads(api_response.data)['results'][0]['user_agent_device'], {'iPhone': 1})
+
+    @patch('ingestion.CLICK_INGESTION_MODE', 'pull')
+    def testBufferedGet(self):
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key,
+                 title='test title', description='test description',
+                 site_name='test site', image='').put()
+        click_buffer = InMemoryClickBuffer()
+        with patch('ingestion.click_buffer', click_buffer):
+            for i in range(3):
+                response = self.app.get('/01?c=campaign',
+                                        follow_redirects=False,
+                                        headers={'Host': 'jmpt.me',
+                                                 'Referer': 'https://www.google.co.jp/search',
+                                                 'X-AppEngine-Country': 'JP'})
+                self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks()), 0)
+        self.assertEqual(len(click_buffer.pending), 3)
+        self.assertEqual(flush_clicks(click_buffer, batch_size=2), 3)
+        self.assertEqual(len(click_buffer.pending), 0)
+        self.assertEqual(len(click_buffer.leased), 0)
+        click_results = Click.query().fetch(1000)
+        self.assertEqual(len(click_results), 3)
+        self.assertEquals(click_results[0].short_url.id(), 'jmpt.me_01')
+        self.assertEquals(click_results[0].location_country, 'JP')
+        self.assertEquals(click_results[0].referrer_medium, 'search')
+        self.assertEquals(click_results[0].custom_code, 'campaign')
+        # two BigQuery batches and one click counter flush
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks()), 3)
+        self.assertEqual(get_click_count('jmpt.me_01'), 3)
+
+    @patch('ingestion.CLICK_INGESTION_MODE', 'pull')
+    def testBufferedGetLeasedAgain(self):
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        click_buffer = InMemoryClickBuffer()
+        with patch('ingestion.click_buffer', click_buffer):
+            for i in range(2):
+                self.app.get('/01', follow_redirects=False, headers={'Host': 'jmpt.me'})
+        with patch.object(click_buffer, 'delete', side_effect=RuntimeError('lease expired')):
+            self.assertRaises(RuntimeError, flush_clicks, click_buffer)
+        # the lease expires and the batch is leased again
+        click_buffer.pending.extend(click_buffer.leased.items())
+        click_buffer.leased.clear()
+        self.assertEqual(flush_clicks(click_buffer), 2)
+        self.assertEqual(Click.query().count(), 2)
+        self.assertEqual(get_click_count('jmpt.me_01'), 2)
+        self.assertEqual(ClickRollup.query().get().count, 2)
+
+    def testBackfillRollups(self):
+        short_url_key = ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                                 team=self.team_key, created_by=self.user_key).put()
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        for referrer in ['https://www.google.co.jp/search', 'https://twitter.com/', None]:
+            build_click(short_url_key, referrer, '127.0.0.1', 'JP', '13', 'shinjuku', '35.693840,139.703549',
+                        'Mozilla/5.0', {}, created_at=yesterday).put()
+        build_click(short_url_key, None, '127.0.0.1', 'US', None, None, None, 'Mozilla/5.0', {}).put()
+        backfill_click_rollups()
+        rollups = ClickRollup.query().fetch(1000)
+        self.assertEqual(len(rollups), 1)
+        self.assertEqual(rollups[0].date, yesterday.date())
+        self.assertEqual(rollups[0].count, 3)
+        self.assertEqual(rollups[0].referrer_medium, {'search': 1, 'social': 1, 'unknown': 1})
+        self.assertEqual(rollups[0].location_country, {'JP': 3})
+        backfill_click_rollups()
+        self.assertEqual(ClickRollup.query().fetch(1000)[0].count, 3)
+        # an interval task of yesterday running after the backfill does not count its clicks again
+        apply_rollup_deltas(aggregate_clicks(Click.query(Click.created_at == yesterday).fetch(1000)), 1)
+        self.assertEqual(ClickRollup.query().fetch(1000)[0].count, 3)
+
+    def testDataRange(self):
+        short_url_key = ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                                 team=self.team_key, created_by=self.user_key).put()
+        # 2018-01-01 is monday, 20 days cover two weeks and a partial one
+        for i in range(20):
+            date = datetime.date(2018, 1, 1) + datetime.timedelta(days=i)
+            ClickRollup(id=rollup_id(short_url_key.id(), date), short_url=short_url_key, date=date, count=1,
+                        location_country={'JP': 1}).put()
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        response = self.app.get('/api/v1/data/jmpt.me/01?from=2018-01-03&to=2018-01-12', follow_redirects=False)
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0]['date'], '2018-01-03')
+        self.assertEqual(len(results), 10)
+        weeks = []
+        cursor = ''
+        while True:
+            response = self.app.get('/api/v1/data/jmpt.me/01?granularity=week&limit=5&cursor=' + cursor,
+                                    follow_redirects=False)
+            page = json.loads(response.data)
+            weeks.extend(page['results'])
+            if not page['more']:
+                break
+            cursor = page['next_cursor']
+        self.assertEqual([w['date'] for w in weeks], ['2018-01-01', '2018-01-08', '2018-01-15'])
+        self.assertEqual([w['count'] for w in weeks], [7, 7, 6])
+        self.assertEqual(weeks[0]['location_country'], {'JP': 7})
+        response = self.app.get('/api/v1/data/jmpt.me/01?granularity=month', follow_redirects=False)
+        self.assertEqual(json.loads(response.data)['results'][0]['count'], 20)
+        response = self.app.get('/api/v1/data/jmpt.me/01?granularity=year', follow_redirects=False)
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/v1/data/jmpt.me/01?from=2018/01/01', follow_redirects=False)
+        self.assertEqual(response.status_code, 400)
+
+    def testClickCount(self):
+        for i in range(5):
+            increment_click_count('jmpt.me_01')
+        self.assertEqual(get_click_count('jmpt.me_01'), 5)
+        flush_click_count('jmpt.me_01')
+        self.assertEqual(sum(s.count for s in ClickCounterShard.query().fetch(1000)), 5)
+        self.assertEqual(get_click_count('jmpt.me_01'), 5)
+        increment_click_count('jmpt.me_01', 2)
+        self.assertEqual(get_click_count('jmpt.me_01'), 7)
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        response = self.app.get('/api/v1/short_urls', follow_redirects=False)
+        self.assertEqual(json.loads(response.data)['results'][0]['count'], 7)
+        detail_response = self.app.get('/api/v1/short_urls/jmpt.me/01', follow_redirects=False)
+        self.assertEqual(json.loads(detail_response.data)['count'], 7)
+
+    def testClickCountFlushFailure(self):
+        for i in range(3):
+            increment_click_count('jmpt.me_01')
+        # one named flush task per short url and interval
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks()), 1)
+        with patch('counters._add_to_shard', side_effect=datastore_errors.Timeout()):
+            self.assertRaises(datastore_errors.Timeout, flush_click_count, 'jmpt.me_01')
+        self.assertEqual(get_click_count('jmpt.me_01'), 3)
+        run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(sum(s.count for s in ClickCounterShard.query().fetch(1000)), 3)
+        self.assertEqual(get_click_count('jmpt.me_01'), 3)
+
+
+class ClickParserTest(unittest.TestCase):
+    def setUp(self):
+        user_agent_cache.clear()
+        referrer_cache.clear()
+
+    def testMemoizedParse(self):
+        user_agent_raw = 'Mozilla/5.0 (iPhone; CPU iPhone OS 11_2_1 like Mac OS X) AppleWebKit/604.4.7 ' \
+                         '(KHTML, like Gecko) Version/11.0 Mobile/15C153 Safari/604.1'
+        for i in range(3):
+            parsed = parse_user_agent(user_agent_raw)
+            self.assertEqual(parsed['user_agent_device'], 'iPhone')
+            self.assertEqual(parsed['user_agent_browser'], 'Mobile Safari')
+            self.assertEqual(parse_referrer('https://www.google.co.jp/search')['referrer_medium'], 'search')
+        self.assertEqual(parse_referrer(None)['referrer_name'], None)
+        self.assertEqual(user_agent_cache.stats()['hits'], 2)
+        self.assertEqual(user_agent_cache.stats()['misses'], 1)
+        self.assertEqual(referrer_cache.stats()['hits'], 2)
+        self.assertEqual(referrer_cache.stats()['misses'], 2)
+
+
+class IDPoolTest(unittest.TestCase):
+    def testBlockAllocation(self):
+        allocator = LocalIDAllocator()
+        pool = IDPool(allocator, block_size=10)
+        ids = [pool.next_id() for i in range(25)]
+        self.assertEqual(ids, range(1, 26))
+        self.assertEqual(allocator.calls, 3)
+        self.assertEqual(pool.remaining(), 5)
+
+    def testEncode(self):
+        self.assertEqual(encode_id(35), 'z')
+        self.assertEqual(encode_id(36), '10')
+        self.assertEqual(encode_id(61, BASE62_ALPHABET), 'Z')
+        self.assertEqual(encode_id(62, BASE62_ALPHABET), '10')
+
+
+class BigQuerySinkTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        known_click_log_tables.clear()
+
+    def tearDown(self):
+        click_log_sink.reset_client()
+        self.testbed.deactivate()
+
+    def testBatching(self):
+        client = FakeBigQueryClient()
+        sink = BigQuerySink(lambda: client, 'jmptme', ensure_table=ensure_click_log_table, batch_size=2, max_age=60)
+        sink.add('click20180101', {'id': 1})
+        self.assertEqual(client.push_calls, 0)
+        sink.add('click20180101', {'id': 2})
+        self.assertEqual(client.push_calls, 1)
+        sink.add('click20180101', {'id': 3})
+        sink.add('click20180102', {'id': 4})
+        self.assertEqual(sink.flush(), 2)
+        self.assertEqual(client.push_calls, 3)
+        self.assertEqual([r['id'] for r in client.tables[('jmptme', 'click20180101')]], [1, 2, 3])
+        self.assertEqual([r['id'] for r in client.tables[('jmptme', 'click20180102')]], [4])
+
+    @patch('bqsink.time.sleep')
+    def testRetry(self, sleep):
+        client = FakeBigQueryClient(fail_times=1)
+        failed = []
+        sink = BigQuerySink(lambda: client, 'jmptme', ensure_table=ensure_click_log_table,
+                            failure_handler=lambda table, rows: failed.append((table, rows)), max_retries=2)
+        sink.add('click20180101', {'id': 1})
+        sink.add('click20180101', {'id': 1})
+        self.assertEqual(sink.flush(), 2)
+        self.assertEqual(client.push_calls, 2)
+        self.assertEqual(len(client.tables[('jmptme', 'click20180101')]), 1)
+        client.fail_times = 2
+        sink.add('click20180101', {'id': 2})
+        self.assertEqual(sink.flush(), 0)
+        self.assertEqual(failed, [('click20180101', [{'id': 2}])])
+
+    def testProvisioning(self):
+        client = FakeBigQueryClient()
+        click_log_sink.reset_client(client)
+        provision_click_log_tables(days=3)
+        self.assertEqual(len(client.tables), 3)
+        self.assertEqual(len(known_click_log_tables), 3)
+        table_name = sorted(known_click_log_tables)[0]
+        known_click_log_tables.clear()
+        with patch.object(client, 'check_table') as check_table:
+            ensure_click_log_table(client, table_name)
+            self.assertEqual(check_table.call_count, 0)
+        self.assertIn(table_name, known_click_log_tables)
+
+
+class ShortURLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_taskqueue_stub(root_path='.')
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.setup_env(
+            user_email='example@example.com',
+            user_id='1234567890',
+            user_is_admin='0',
+            overwrite=True)
+        self.app = app.test_client()
+        ndb.get_context().clear_cache()
+        short_url_cache.clear()
+        scheduled_intervals.clear()
+        new_team = Team(team_name='hoge', billing_plan='trial',
+                        team_domain='ysk')
+        new_team_key = new_team.put()
+        self.team_key = new_team_key
+        self.team_id = new_team_key.id()
+        user_key_name = "{}_{}".format(self.team_id, users.get_current_user().user_id())
+        new_team_user = User(id=user_key_name,
+                             user_name='hoge',
+                             email='example@example.com',
+                             team=new_team_key,
+                             role='primary_owner',
+                             user=users.get_current_user())
+        self.user_key = new_team_user.put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testResolve(self):
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        self.assertEqual(get_long_url('jmpt.me_01'), 'https://github.com')
+        self.assertEqual(short_url_cache.stats()['misses'], 1)
+        self.assertEqual(get_long_url('jmpt.me_01'), 'https://github.com')
+        self.assertEqual(short_url_cache.stats()['hits'], 1)
+        short_url_cache.clear()
+        self.assertEqual(get_long_url('jmpt.me_01'), 'https://github.com')
+        self.assertEqual(get_long_url('jmpt.me_02'), None)
+
+    def testInvalidateOnDelete(self):
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        response = self.app.get('/01', follow_redirects=False, headers={'Host': 'jmpt.me'})
+        self.assertEqual(response.status_code, 302)
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        delete_response = self.app.delete('/api/v1/short_urls/jmpt.me/01')
+        self.assertEqual(delete_response.status_code, 200)
+        response = self.app.get('/01', follow_redirects=False, headers={'Host': 'jmpt.me'})
+        self.assertEqual(response.status_code, 404)
+
+    def testNegativeLookup(self):
+        self.assertEqual(get_long_url('jmpt.me_02'), None)
+        with patch('cache.ShortURL.get_by_id') as get_by_id:
+            self.assertEqual(get_long_url('jmpt.me_02'), None)
+            self.assertEqual(get_by_id.call_count, 0)
+
+    @patch('opengraph.OpenGraph')
+    def testPathFilter(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        rebuild_path_filters('jmpt.me')
+        self.assertEqual(get_long_url('jmpt.me_01'), 'https://github.com')
+        with patch('cache.ShortURL.get_by_id') as get_by_id:
+            self.assertEqual(get_long_url('jmpt.me_unknown'), None)
+            self.assertEqual(get_by_id.call_count, 0)
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        response = self.app.post('/api/v1/shorten',
+                                 data=json.dumps({'url': 'https://github.com/yosukesuzuki', 'domain': 'jmpt.me',
+                                                  'custom_path': 'unknown'}),
+                                 content_type='application/json',
+                                 follow_redirects=False)
+        self.assertEqual(response.status_code, 200)
+        short_url_cache.clear()
+        self.assertEqual(get_long_url('jmpt.me_unknown'), 'https://github.com/yosukesuzuki')
+        # the filter is written by the flush task, the primed memcache entry resolves the path meanwhile
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=PATH_FILTER_QUEUE_NAME)), 1)
+        run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=PATH_FILTER_QUEUE_NAME)), 0)
+        memcache.flush_all()
+        short_url_cache.clear()
+        self.assertEqual(get_long_url('jmpt.me_unknown'), 'https://github.com/yosukesuzuki')
+        with patch('cache._update_path_filter', side_effect=datastore_errors.Timeout()):
+            self.app.delete('/api/v1/short_urls/jmpt.me/unknown')
+            self.assertEqual(flush_path_filters(), 0)
+        # the failed change stays queued until its lease expires
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=PATH_FILTER_QUEUE_NAME)), 1)
+
+    @patch('opengraph.OpenGraph')
+    def testRedirectRecord(self, OpenGraph):
+        OpenGraph.return_value = {'title': 'GitHub', 'description': '', 'site_name': 'GitHub', 'image': ''}
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.post('/api/v1/shorten',
+                      data=json.dumps({'url': 'https://github.com', 'domain': 'jmpt.me', 'custom_path': 'gh'}),
+                      content_type='application/json',
+                      follow_redirects=False)
+        redirect_record = Redirect.get_by_id('jmpt.me_gh')
+        self.assertEqual(redirect_record.long_url, 'https://github.com')
+        self.assertEqual(redirect_record.team, self.team_key)
+        self.app.delete('/api/v1/short_urls/jmpt.me/gh')
+        self.assertEqual(Redirect.get_by_id('jmpt.me_gh'), None)
+        ShortURL(id='jmpt.me_01', long_url='https://github.com', short_url='jmpt.me/01',
+                 team=self.team_key, created_by=self.user_key).put()
+        backfill_redirects()
+        self.assertEqual(Redirect.get_by_id('jmpt.me_01').long_url, 'https://github.com')
 
 
 class SendInvitationTest(unittest.TestCase):
@@ -519,6 +1335,8 @@ class SendInvitationTest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path='.')
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
         self.testbed.setup_env(
             user_email='example@example.com',
             user_id='1234567890',
@@ -548,8 +1366,8 @@ class SendInvitationTest(unittest.TestCase):
     def tearDown(self):
         self.testbed.deactivate()
 
-    @mock.patch('tasks.sendgrid.SendGridAPIClient')
-    def testInvitation(self, send_gric_client_obj):
+    @mock.patch('tasks.mail_transport', new_callable=FakeMailTransport)
+    def testInvitation(self, mail_transport):
         bad_response = self.app.get('/page/settings',
                                     follow_redirects=False)
         self.assertEqual(bad_response.status_code, 401)
@@ -566,6 +1384,10 @@ class SendInvitationTest(unittest.TestCase):
         self.assertEqual(invitations[0].sent_to, 'invitation@example.com')
         self.assertEqual(invitations[0].team, self.team_key)
         self.assertEqual(invitations[0].created_by, self.user_key)
+        self.assertEqual(mail_transport.send_calls, 0)
+        run_deferred_tasks(self.taskqueue_stub)
+        self.assertEqual(mail_transport.sent[0]['to'], [{'email': 'invitation@example.com'}])
+        self.assertEqual(Invitation.get_by_id(invitations[0].key.id()).sent_at is not None, True)
         self.testbed.setup_env(
             user_email='invitation@example.com',
             user_id='1234567891',
@@ -579,8 +1401,8 @@ class SendInvitationTest(unittest.TestCase):
         self.assertEquals(results[0].email, 'invitation@example.com')
         self.assertEquals(results[0].role, 'normal')
 
-    @mock.patch('tasks.sendgrid.SendGridAPIClient')
-    def testExistUserInvitation(self, send_gric_client_obj):
+    @mock.patch('tasks.mail_transport', new_callable=FakeMailTransport)
+    def testExistUserInvitation(self, mail_transport):
         bad_response = self.app.get('/page/settings',
                                     follow_redirects=False)
         self.assertEqual(bad_response.status_code, 401)
@@ -600,6 +1422,29 @@ class SendInvitationTest(unittest.TestCase):
         invalid_accept = self.app.get('/page/invitation/{}'.format(invitations[0].key.id()))
         self.assertEquals(invalid_accept.status_code, 400)
 
+    @mock.patch('tasks.mail_transport', new_callable=lambda: FakeMailTransport(fail_times=1))
+    def testBatchInvitationRetry(self, mail_transport):
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        inv_response = self.app.post('/page/settings',
+                                     data={'email': 'invitation1@example.com, invitation2@example.com'},
+                                     follow_redirects=False)
+        self.assertEquals(inv_response.status_code, 200)
+        bad_response = self.app.post('/page/settings',
+                                     data={'email': 'invitation1@example.com, invitation2'},
+                                     follow_redirects=False)
+        self.assertEquals(bad_response.status_code, 200)
+        invitation_ids = [i.key.id() for i in Invitation.query().fetch(1000)]
+        self.assertEqual(len(invitation_ids), 2)
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEqual(len(tasks), 1)
+        with self.assertRaises(InvitationDeliveryError):
+            deferred.run(tasks[0].payload)
+        deferred.run(tasks[0].payload)
+        self.assertEqual(mail_transport.send_calls, 2)
+        self.assertEqual(sorted(p['to'][0]['email'] for p in mail_transport.sent),
+                         ['invitation1@example.com', 'invitation2@example.com'])
+        self.assertEqual(deliver_invitations(invitation_ids, 'jmpt.me'), 0)
+
 
 class ChangeRoleTest(unittest.TestCase):
     def setUp(self):
@@ -666,3 +1511,34 @@ class ChangeRoleTest(unittest.TestCase):
         self.assertEquals(role_response.status_code, 302)
         users = User.query().filter(User.team == self.team_key).order(-User.created_at).fetch()
         self.assertEquals(users[0].role, 'admin')
+
+    def test_auth_cache(self):
+        inv_user_id = '{}_1234567891'.format(self.team_id)
+        self.assertEqual(validate_team_user(self.team_id, '1234567891'), 'hoge')
+        with patch('auth.User.get_by_id') as get_by_id:
+            self.assertEqual(validate_team_user(self.team_id, '1234567891'), 'hoge')
+            self.assertEqual(get_by_id.call_count, 0)
+        self.assertEqual(team_user_cache.stats()['hits'] > 0, True)
+        inv_user = User.get_by_id(inv_user_id)
+        inv_user.in_use = False
+        inv_user.put()
+        self.assertEqual(validate_team_user(self.team_id, '1234567891'), '')
+        self.assertEqual(team_user_cache.get(inv_user_id), None)
+
+    def test_settings_rpcs(self):
+        self.testbed.setup_env(
+            user_email='example@example.com',
+            user_id='1234567890',
+            user_is_admin='0',
+            overwrite=True)
+        self.app.set_cookie('localhost', 'team', str(self.team_id))
+        self.app.get('/page/settings', follow_redirects=False)
+        calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count_rpcs', lambda service, call, request, response: calls.append(call), 'datastore_v3')
+        ndb.get_context().clear_cache()
+        response = self.app.get('/page/settings', follow_redirects=False)
+        self.assertEqual(response.status_code, 200)
+        # User and Team in one get_multi by team_id_required, the team users and tokens queries
+        self.assertEqual(calls.count('Get'), 1)
+        self.assertEqual(calls.count('RunQuery'), 2)
@@ -1,3 +1,4 @@
+import hashlib
 import datetime
 
 import validators
@@ -32,6 +33,11 @@ class User(ndb.Model):
     updated_at = ndb.DateTimeProperty(auto_now=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    def _post_put_hook(self, future):
+        # role and in_use changes have to reach the auth cache at once, auth imports models so it is imported here
+        from auth import invalidate_team_user
+        invalidate_team_user(self.key.id())
+
 
 class Team(ndb.Model):
     """
@@ -58,6 +64,7 @@ class Invitation(ndb.Model):
     team = ndb.KeyProperty(required=True)
     created_by = ndb.KeyProperty(kind=User)
     accepted = ndb.BooleanProperty(default=False)
+    sent_at = ndb.DateTimeProperty()
     updated_at = ndb.DateTimeProperty(auto_now=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
     expired_at = ndb.ComputedProperty(lambda self: self.created_at + datetime.timedelta(days=7))
@@ -82,23 +89,155 @@ class ShortURL(ndb.Model):
     tags = ndb.StringProperty(repeated=True)
     count = ndb.IntegerProperty()
     generated_by_api = ndb.BooleanProperty(default=False)
+    # OGP data is filled in by a task, None for short urls created before that and means done
+    enrichment_status = ndb.StringProperty(choices=['pending', 'done', 'failed'])
+    enrichment_warning = ndb.StringProperty()
     updated_at = ndb.DateTimeProperty(auto_now=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
 
+class Redirect(ndb.Model):
+    """
+    key_name == domain name + "_" + short url path, same as ShortURL
+    slim copy of the fields needed to redirect, written together with ShortURL
+    """
+    long_url = ndb.TextProperty(required=True)
+    team = ndb.KeyProperty(kind=Team)
+    custom_rule = ndb.JsonProperty()
+
+    @classmethod
+    def from_short_url(cls, short_url):
+        return cls(id=short_url.key.id(), long_url=short_url.long_url, team=short_url.team,
+                   custom_rule=short_url.custom_rule)
+
+
+class LongURLIndex(ndb.Model):
+    """
+    key_name == team id + "_" + sha1 of domain name + " " + long url
+    short url reused by shorten in dedup mode, the first short url of the page until it is deleted
+    """
+    short_url = ndb.KeyProperty(required=True, kind=ShortURL)
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def index_id(team_id, domain, long_url):
+        value = u'{} {}'.format(domain, long_url).encode('utf-8')
+        return '{}_{}'.format(team_id, hashlib.sha1(value).hexdigest())
+
+    @classmethod
+    def from_short_url(cls, short_url):
+        domain = short_url.key.id().split('_', 1)[0]
+        return cls(id=cls.index_id(short_url.team.id(), domain, short_url.long_url), short_url=short_url.key)
+
+
+class TagSummary(ndb.Model):
+    """
+    key_name == team id
+    number of short urls of the team by tag, written in the transactions changing tags of the team's short urls
+    """
+    counts = ndb.JsonProperty()
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+    def apply(self, removed, added):  # type: (set, set) -> None
+        counts = dict(self.counts or {})
+        for tag in removed:
+            counts[tag] = counts.get(tag, 0) - 1
+            if counts[tag] <= 0:
+                del counts[tag]
+        for tag in added:
+            counts[tag] = counts.get(tag, 0) + 1
+        self.counts = counts
+
+
+class PathFilter(ndb.Model):
+    """
+    key_name == domain name + "_" + shard number
+    counting bloom filter of the short url paths existing on the domain, paths are sharded by crc32
+    version is incremented on every change, ready is set once the filter was built from all existing paths
+    """
+    counters = ndb.BlobProperty(compressed=True)
+    size = ndb.IntegerProperty()
+    hash_count = ndb.IntegerProperty()
+    version = ndb.IntegerProperty(default=0)
+    ready = ndb.BooleanProperty(default=False)
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
 class ShortURLID(ndb.Model):
     long_url = ndb.StringProperty()
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
 
+class ClickCounterShard(ndb.Model):
+    """
+    key_name == short url key name + "_" + shard number
+    """
+    short_url = ndb.KeyProperty(required=True, kind=ShortURL)
+    count = ndb.IntegerProperty(default=0)
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
+class ClickRollup(ndb.Model):
+    """
+    key_name == short url key name + "_" + YYYYMMDD
+    daily click total and click counts by value of each dimension
+    """
+    short_url = ndb.KeyProperty(required=True, kind=ShortURL)
+    date = ndb.DateProperty(required=True)
+    count = ndb.IntegerProperty(default=0)
+    referrer_medium = ndb.JsonProperty()
+    location_country = ndb.JsonProperty()
+    user_agent_device = ndb.JsonProperty()
+    user_agent_browser = ndb.JsonProperty()
+    intervals = ndb.IntegerProperty(repeated=True, indexed=False)  # click intervals of write_click_interval counted
+    backfilled = ndb.BooleanProperty(default=False, indexed=False)
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
+class OGPMetadata(ndb.Model):
+    """
+    key_name == sha1 of normalized long url
+    OGP data shared by short urls of the same page, warning is set for pages which could not be fetched or parsed
+    """
+    url = ndb.TextProperty()
+    title = ndb.StringProperty(indexed=False)
+    description = ndb.TextProperty()
+    site_name = ndb.StringProperty(indexed=False)
+    image = ndb.StringProperty(indexed=False)
+    warning = ndb.StringProperty(indexed=False)
+    expires_at = ndb.DateTimeProperty()
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
+class QRExport(ndb.Model):
+    """
+    key_name = uuid
+    ZIP archive of QR codes of short urls written to Cloud Storage by build_qr_export
+    """
+    team = ndb.KeyProperty(required=True, kind=Team)
+    created_by = ndb.KeyProperty(kind=User)
+    short_urls = ndb.StringProperty(repeated=True, indexed=False)  # short url key names
+    size = ndb.IntegerProperty(indexed=False)
+    error_level = ndb.StringProperty(indexed=False)
+    image_format = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(choices=['pending', 'done', 'failed'], default='pending')
+    object_name = ndb.StringProperty(indexed=False)
+    failed = ndb.StringProperty(repeated=True, indexed=False)  # short urls which could not be rendered
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+
 class APIToken(ndb.Model):
     """
-    Token == key_name, add prefix 'jmptme-' to detect leakage in Github or similar system
+    sha256 of Token == key_name, the token itself is shown once when it is generated and never stored
+    tokens generated before hashing are keyed by the raw token until their first use or backfill_api_tokens
+    add prefix 'jmptme-' to detect leakage in Github or similar system
     """
     team = ndb.KeyProperty(required=True, kind=Team)
     created_by = ndb.KeyProperty(kind=User)
     description = ndb.TextProperty()
     revoked = ndb.BooleanProperty(default=False)
+    hint = ndb.StringProperty(indexed=False)  # last characters of the token to tell tokens apart
     updated_at = ndb.DateTimeProperty(auto_now=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
@@ -0,0 +1,112 @@
+import urllib
+import hashlib
+import datetime
+from urllib2 import HTTPError
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+import opengraph
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from cache import count, counter
+from models import OGPMetadata
+from workers import map_concurrently
+
+OGP_FIELDS = ('title', 'description', 'site_name', 'image')
+OGP_MEMCACHE_KEY = 'ogp-{}'
+OGP_TTL = 60 * 60 * 24 * 7
+# pages which could not be fetched are often fixed soon, so negative entries are short lived
+OGP_NEGATIVE_TTL = 60 * 60
+
+
+def fetch_ogp(url):  # type: (str) -> (dict, str)
+    """
+    OGP data of the url and a warning for the user, None when the page was parsed
+    """
+    try:
+        return opengraph.OpenGraph(url=url), None
+    except HTTPError:
+        ogp = {'title': '', 'description': '', 'site_name': '', 'image': ''}
+        return ogp, 'cannot look up URL, is this right URL?'
+    except (KeyError, AttributeError):
+        ogp = {'title': '', 'description': '', 'site_name': '', 'image': ''}
+        return ogp, 'cannot parse OGP data'
+
+
+def normalize_url(url):  # type: (str) -> str
+    """
+    scheme and host lower cased, fragment removed and query parameters sorted
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    query = urllib.urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme.lower(), netloc.lower(), path, query, ''))
+
+
+def ogp_cache_id(url):  # type: (str) -> str
+    return hashlib.sha1(normalize_url(url)).hexdigest()
+
+
+def get_ogp(url):  # type: (str) -> (dict, str)
+    return get_ogp_multi([url])[0]
+
+
+def get_ogp_multi(urls):  # type: (list) -> list
+    """
+    (OGP data, warning) of each url, memcache -> datastore -> fetching the pages concurrently
+    """
+    ids = [ogp_cache_id(url) for url in urls]
+    results = {}
+    cached = memcache.get_multi([OGP_MEMCACHE_KEY.format(i) for i in set(ids)])
+    for cache_id in set(ids):
+        entry = cached.get(OGP_MEMCACHE_KEY.format(cache_id))
+        if entry is not None:
+            count('ogp.memcache_hits')
+            count('ogp.negative_hits', 1 if entry[1] is not None else 0)
+            results[cache_id] = entry
+    missing = [i for i in set(ids) if i not in results]
+    now = datetime.datetime.utcnow()
+    refill = {}
+    for cache_id, entity in zip(missing, ndb.get_multi([ndb.Key(OGPMetadata, i) for i in missing])):
+        if entity is not None and entity.expires_at > now:
+            count('ogp.datastore_hits')
+            count('ogp.negative_hits', 1 if entity.warning is not None else 0)
+            entry = ({f: getattr(entity, f) or '' for f in OGP_FIELDS}, entity.warning)
+            results[cache_id] = entry
+            refill[cache_id] = (entry, int((entity.expires_at - now).total_seconds()))
+    fetch_ids = []
+    fetch_urls = []
+    for cache_id, url in zip(ids, urls):
+        if cache_id not in results and cache_id not in fetch_ids:
+            fetch_ids.append(cache_id)
+            fetch_urls.append(url)
+    entities = []
+    for cache_id, url, fetched in zip(fetch_ids, fetch_urls, map_concurrently(fetch_ogp, fetch_urls)):
+        count('ogp.misses')
+        ogp, warning = fetched or ({}, 'cannot look up URL, is this right URL?')
+        entry = ({f: ogp.get(f, '') or '' for f in OGP_FIELDS}, warning)
+        ttl = OGP_TTL if warning is None else OGP_NEGATIVE_TTL
+        results[cache_id] = entry
+        refill[cache_id] = (entry, ttl)
+        entities.append(OGPMetadata(id=cache_id, url=normalize_url(url), warning=warning,
+                                    expires_at=now + datetime.timedelta(seconds=ttl), **entry[0]))
+    if entities:
+        ndb.put_multi(entities)
+    for cache_id, (entry, ttl) in refill.items():
+        memcache.set(OGP_MEMCACHE_KEY.format(cache_id), entry, time=ttl)
+    return [results[i] for i in ids]
+
+
+def ogp_cache_stats():
+    """
+    per-instance hit rates of the OGP cache, negative hits are included in memcache and datastore hits
+    """
+    memcache_hits = counter('ogp.memcache_hits')
+    datastore_hits = counter('ogp.datastore_hits')
+    lookups = memcache_hits + datastore_hits + counter('ogp.misses')
+    return {'memcache_hits': memcache_hits,
+            'datastore_hits': datastore_hits,
+            'negative_hits': counter('ogp.negative_hits'),
+            'misses': counter('ogp.misses'),
+            'hit_rate': float(memcache_hits + datastore_hits) / lookups if lookups else 0.0}
@@ -0,0 +1,102 @@
+import hashlib
+import zipfile
+from StringIO import StringIO
+
+import qrcode
+import qrcode.image.svg
+from google.appengine.api import memcache
+
+from cache import count
+from workers import map_concurrently
+
+QR_MEMCACHE_KEY = 'qr-{}'
+QR_TTL = 60 * 60 * 24 * 30
+# change this when rendering changes, cached images and ETags of the old rendering are not used anymore
+QR_RENDER_VERSION = 1
+QR_ERROR_LEVELS = {'L': qrcode.constants.ERROR_CORRECT_L,
+                   'M': qrcode.constants.ERROR_CORRECT_M,
+                   'Q': qrcode.constants.ERROR_CORRECT_Q,
+                   'H': qrcode.constants.ERROR_CORRECT_H}
+QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+QR_DEFAULT_ERROR_LEVEL = 'M'
+QR_DEFAULT_FORMAT = 'png'
+# pixels per module of the code
+QR_DEFAULT_SIZE = 10
+QR_MIN_SIZE = 1
+QR_MAX_SIZE = 40
+# images rendered concurrently and held in memory at once while writing an archive
+QR_EXPORT_CHUNK_SIZE = 50
+
+
+def render_qr(data, size=QR_DEFAULT_SIZE, error_level=QR_DEFAULT_ERROR_LEVEL, image_format=QR_DEFAULT_FORMAT):
+    # type: (str, int, str, str) -> str
+    """
+    svg is written as paths without PIL, so it is cheaper to render and smaller than png at any size
+    """
+    image_factory = qrcode.image.svg.SvgPathImage if image_format == 'svg' else None
+    code = qrcode.QRCode(error_correction=QR_ERROR_LEVELS[error_level], box_size=size,
+                         image_factory=image_factory)
+    code.add_data(data)
+    image_io = StringIO()
+    code.make_image().save(image_io)
+    return image_io.getvalue()
+
+
+def qr_id(domain, path, size, error_level, image_format):  # type: (str, str, int, str, str) -> str
+    value = u'{} {} {} {} {} {}'.format(QR_RENDER_VERSION, domain, path, size, error_level, image_format)
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def get_qr(domain, path, size=QR_DEFAULT_SIZE, error_level=QR_DEFAULT_ERROR_LEVEL, image_format=QR_DEFAULT_FORMAT):
+    # type: (str, str, int, str, str) -> str
+    """
+    QR code image of the short url, rendering only depends on the arguments so cached images never change
+    """
+    memcache_key = QR_MEMCACHE_KEY.format(qr_id(domain, path, size, error_level, image_format))
+    image = memcache.get(memcache_key)
+    if image is not None:
+        count('qr.memcache_hits')
+        return image
+    count('qr.renders')
+    image = render_qr(u'https://{}/{}'.format(domain, path), size, error_level, image_format)
+    memcache.set(memcache_key, image, time=QR_TTL)
+    return image
+
+
+class _WriteOnlyFile(object):
+    """
+    file interface zipfile needs for writestr and close, on top of a stream which can not seek
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+
+def write_qr_zip(stream, key_names, size=QR_DEFAULT_SIZE, error_level=QR_DEFAULT_ERROR_LEVEL,
+                 image_format=QR_DEFAULT_FORMAT):  # type: (file, list, int, str, str) -> list
+    """
+    write a ZIP archive of the QR codes of short urls to stream, one file per short url named domain/path.format
+    images are rendered by a thread pool a chunk at a time, returns key names of the images which failed
+    """
+    failed = []
+    with zipfile.ZipFile(_WriteOnlyFile(stream), 'w', zipfile.ZIP_DEFLATED) as archive:
+        for i in range(0, len(key_names), QR_EXPORT_CHUNK_SIZE):
+            chunk = [k.split('_', 1) for k in key_names[i:i + QR_EXPORT_CHUNK_SIZE]]
+            images = map_concurrently(lambda item: get_qr(item[0], item[1], size, error_level, image_format), chunk)
+            for (domain, path), image in zip(chunk, images):
+                if image is None:
+                    failed.append('{}_{}'.format(domain, path))
+                    continue
+                archive.writestr(u'{}/{}.{}'.format(domain, path, image_format), image)
+    return failed
@@ -0,0 +1,151 @@
+import json
+import logging
+import datetime
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb, deferred
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import ShortURL, Click, ClickRollup
+
+ROLLUP_DIMENSIONS = ('referrer_medium', 'location_country', 'user_agent_device', 'user_agent_browser')
+ROLLUP_UNKNOWN_VALUE = 'unknown'
+ROLLUP_RETRY_DELAY = 30
+ROLLUP_BACKFILL_BATCH_SIZE = 20
+ROLLUP_GRANULARITIES = ('day', 'week', 'month')
+
+
+def rollup_id(short_url_id, date):  # type: (str, datetime.date) -> str
+    return '{}_{}'.format(short_url_id, date.strftime('%Y%m%d'))
+
+
+def aggregate_clicks(clicks):  # type: (list) -> dict
+    """
+    rollup deltas of clicks keyed by (short url key name, date)
+    """
+    deltas = {}
+    for click in clicks:
+        key = (click.short_url.id(), click.created_at.date())
+        if key not in deltas:
+            deltas[key] = dict({d: {} for d in ROLLUP_DIMENSIONS}, count=0)
+        delta = deltas[key]
+        delta['count'] += 1
+        for dimension in ROLLUP_DIMENSIONS:
+            value = getattr(click, dimension) or ROLLUP_UNKNOWN_VALUE
+            delta[dimension][value] = delta[dimension].get(value, 0) + 1
+    return deltas
+
+
+def _new_rollup(short_url_id, date):
+    return ClickRollup(id=rollup_id(short_url_id, date), short_url=ndb.Key(ShortURL, short_url_id), date=date,
+                       count=0, **{d: {} for d in ROLLUP_DIMENSIONS})
+
+
+@ndb.transactional
+def _apply_rollup_delta(short_url_id, date, delta, interval=None):
+    rollup = ClickRollup.get_by_id(rollup_id(short_url_id, date)) or _new_rollup(short_url_id, date)
+    # backfilled rollups already count every click of their day
+    if rollup.backfilled or interval in rollup.intervals:
+        return
+    if interval is not None:
+        rollup.intervals.append(interval)
+    rollup.count += delta['count']
+    for dimension in ROLLUP_DIMENSIONS:
+        values = dict(getattr(rollup, dimension) or {})
+        for value, count in delta[dimension].items():
+            values[value] = values.get(value, 0) + count
+        setattr(rollup, dimension, values)
+    rollup.put()
+
+
+def apply_rollup_deltas(deltas, interval=None):  # type: (dict, int) -> None
+    """
+    add deltas to the daily rollups, deltas failing on contention are retried in background
+    deltas of an interval are added once per rollup, so the clicks of a retried interval are not counted twice
+    """
+    failed = {}
+    for (short_url_id, date), delta in deltas.items():
+        try:
+            _apply_rollup_delta(short_url_id, date, delta, interval)
+        except datastore_errors.TransactionFailedError:
+            failed[(short_url_id, date)] = delta
+    if failed:
+        logging.warning('{} rollup updates failed, retry in background'.format(len(failed)))
+        deferred.defer(apply_rollup_deltas, failed, interval, _countdown=ROLLUP_RETRY_DELAY)
+
+
+def backfill_click_rollups(cursor=None, until=None):
+    """
+    rebuild the rollups of the days before until (default: today, UTC) from Click entities
+    rollups are overwritten, so it can run again, days from until are left to the incremental writers
+    backfilled rollups ignore later deltas, the clicks of intervals written after the backfill are counted already
+    """
+    until = until or datetime.datetime.utcnow().date()
+    until_datetime = datetime.datetime.combine(until, datetime.time())
+    q = ShortURL.query().order(ShortURL.key)
+    short_url_keys, next_cursor, more = q.fetch_page(ROLLUP_BACKFILL_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor),
+                                                     keys_only=True)
+    for short_url_key in short_url_keys:
+        clicks = Click.query(Click.short_url == short_url_key, Click.created_at < until_datetime).order(
+            Click.created_at).iter(batch_size=1000)
+        rollups = []
+        for (short_url_id, date), delta in aggregate_clicks(clicks).items():
+            rollup = _new_rollup(short_url_id, date)
+            rollup.populate(backfilled=True, **delta)
+            rollups.append(rollup)
+        ndb.put_multi(rollups)
+    logging.info('rollups of {} short urls backfilled'.format(len(short_url_keys)))
+    if more and next_cursor:
+        deferred.defer(backfill_click_rollups, next_cursor.urlsafe(), until)
+
+
+def bucket_start(date, granularity):  # type: (datetime.date, str) -> datetime.date
+    if granularity == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if granularity == 'month':
+        return date.replace(day=1)
+    return date
+
+
+def _new_bucket(date):
+    return dict({d: {} for d in ROLLUP_DIMENSIONS}, date=date.isoformat(), count=0)
+
+
+def _merge_rollup(bucket, rollup):
+    bucket['count'] += rollup.count
+    for dimension in ROLLUP_DIMENSIONS:
+        values = bucket[dimension]
+        for value, count in (getattr(rollup, dimension) or {}).items():
+            values[value] = values.get(value, 0) + count
+
+
+def stream_rollups(query, granularity, page_size, cursor):
+    """
+    JSON response chunks of rollups merged by granularity, one bucket at a time
+    a page ends after page_size daily rollups at a bucket boundary, so buckets are never split across pages
+    """
+    iterator = query.iter(start_cursor=cursor, produce_cursors=True, batch_size=page_size)
+    yield '{"results": ['
+    bucket = None
+    bucket_date = None
+    days = 0
+    separator = ''
+    next_cursor = None
+    for rollup in iterator:
+        date = bucket_start(rollup.date, granularity)
+        if bucket is not None and date != bucket_date:
+            if days >= page_size:
+                next_cursor = iterator.cursor_before()
+                break
+            yield separator + json.dumps(bucket)
+            separator = ', '
+            bucket = None
+        if bucket is None:
+            bucket = _new_bucket(date)
+            bucket_date = date
+        _merge_rollup(bucket, rollup)
+        days += 1
+    if bucket is not None:
+        yield separator + json.dumps(bucket)
+    next_cursor = next_cursor.urlsafe() if next_cursor else None
+    yield '], "next_cursor": {}, "more": {}}}'.format(json.dumps(next_cursor), json.dumps(next_cursor is not None))
@@ -1,22 +1,74 @@
 import os
 import json
 import logging
-import uuid
 import random
+import calendar
 import datetime
 
 from user_agents import parse
 from oauth2client.service_account import ServiceAccountCredentials
 from bigquery import get_client, BIGQUERY_SCOPE
-from google.appengine.api import app_identity
-from google.appengine.ext import deferred
-import sendgrid
+from google.appengine.api import app_identity, memcache, taskqueue
+from google.appengine.ext import deferred, ndb
+from google.appengine.datastore.datastore_query import Cursor
 from referer_parser import Referer
+import cloudstorage
 
-from models import Click, User, Invitation, Team, ShortURL
+from models import Click, Invitation, ShortURL, Redirect, LongURLIndex, Team, TagSummary, QRExport, APIToken
+from cache import LRUCache, touch_short_urls
+from bqsink import BigQuerySink, BQ_BATCH_SIZE
+from counters import increment_click_count
+from rollups import aggregate_clicks, apply_rollup_deltas
+from ogp import get_ogp_multi
+from mailer import mail_transport
+from fulltext import index_short_urls, SEARCH_BATCH_SIZE
+from qr import write_qr_zip
+from workers import defer_per_interval
+from auth import migrate_legacy_token, LEGACY_TOKEN_LENGTH
 
 # change this
 LOG_DATASET_NAME = 'jmptme'
+BACKFILL_BATCH_SIZE = 500
+# a few hundred distinct user agent and referrer strings make up most of the traffic
+PARSER_CACHE_SIZE = 2000
+CLICK_LOG_PROVISION_DAYS = 7
+# clicks written by write_click_log go to the rollups and BigQuery by one task per interval
+CLICK_INTERVAL_SECONDS = 60
+# the clicks of an interval are queried after it ends, the delay lets the query see its last clicks
+CLICK_INTERVAL_DELAY = 30
+KNOWN_TABLE_MEMCACHE_KEY = 'bq-table-{}'
+QR_EXPORT_OBJECT_NAME = '/{}/qr-exports/{}.zip'
+ENRICHMENT_BATCH_SIZE = 50
+# SendGrid accepts up to 1000 personalizations per request
+INVITATION_BATCH_SIZE = 100
+INVITATION_RETRY_OPTIONS = taskqueue.TaskRetryOptions(task_retry_limit=8, min_backoff_seconds=10,
+                                                      max_backoff_seconds=60 * 60)
+QR_EXPORT_RETRY_OPTIONS = taskqueue.TaskRetryOptions(task_retry_limit=3)
+CLICK_LOG_SCHEMA = [
+    {'name': 'id', 'type': 'INTEGER', 'mode': 'required'},
+    {'name': 'short_url_id', 'type': 'STRING', 'mode': 'required'},
+    {'name': 'referrer', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'referrer_name', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'referrer_medium', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'ip_address', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'location_country', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'location_region', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'location_city', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'location_lat_long', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_raw', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_device', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_device_brand', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_device_model', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_os', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_os_version', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_browser', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'user_agent_browser_version', 'type': 'STRING', 'mode': 'nullable'},
+    {'name': 'custom_code', 'type': 'STRING', 'mode': 'nullable'},
+]
+
+known_click_log_tables = set()
+user_agent_cache = LRUCache('user_agent', max_size=PARSER_CACHE_SIZE)
+referrer_cache = LRUCache('referrer', max_size=PARSER_CACHE_SIZE)
 
 
 def get_bq_client():
@@ -30,42 +82,75 @@ def get_bq_client():
     return client
 
 
+def parse_user_agent(user_agent_raw):  # type: (str) -> dict
+    """
+    memoized user agent parsing, returns Click properties
+    """
+    parsed = user_agent_cache.get(user_agent_raw)
+    if parsed is None:
+        user_agent = parse(user_agent_raw)
+        parsed = {'user_agent_device': user_agent.device.family,
+                  'user_agent_device_brand': user_agent.device.brand,
+                  'user_agent_device_model': user_agent.device.model,
+                  'user_agent_os': user_agent.os.family,
+                  'user_agent_os_version': user_agent.os.version_string,
+                  'user_agent_browser': user_agent.browser.family,
+                  'user_agent_browser_version': user_agent.browser.version_string}
+        user_agent_cache.set(user_agent_raw, parsed)
+    return parsed
+
+
+def parse_referrer(referrer):  # type: (str) -> dict
+    """
+    memoized referrer parsing, returns Click properties
+    """
+    parsed = referrer_cache.get(referrer)
+    if parsed is None:
+        try:
+            referrer_parsed = Referer(referrer)
+            parsed = {'referrer_name': referrer_parsed.referer,
+                      'referrer_medium': referrer_parsed.medium}
+        except AttributeError:
+            parsed = {'referrer_name': None,
+                      'referrer_medium': None}
+        referrer_cache.set(referrer, parsed)
+    return parsed
+
+
+def build_click(short_url_key, referrer, ip_address,
+                location_country, location_region, location_city, location_lat_long,
+                user_agent, get_parameters, click_id=None, created_at=None):
+    user_agent_raw = str(user_agent)
+    properties = dict(parse_user_agent(user_agent_raw), **parse_referrer(referrer))
+    if created_at is not None:
+        # passing None would keep auto_now_add from setting it
+        properties['created_at'] = created_at
+    return Click(id=click_id,
+                 short_url=short_url_key,
+                 referrer=referrer,
+                 ip_address=ip_address,
+                 location_country=location_country,
+                 location_region=location_region,
+                 location_city=location_city,
+                 location_lat_long=location_lat_long,
+                 user_agent_raw=user_agent_raw,
+                 custom_code=get_parameters.get('c'),
+                 **properties)
+
+
 def write_click_log(short_url_key, referrer, ip_address,
                     location_country, location_region, location_city, location_lat_long,
                     user_agent, get_parameters):
-    user_agent_raw = str(user_agent)
-    user_agent = parse(user_agent_raw)
-    try:
-        referrer_parsed = Referer(referrer)
-        referrer_name = referrer_parsed.referer
-        referrer_medium = referrer_parsed.medium
-    except AttributeError:
-        referrer_name = None
-        referrer_medium = None
-    click = Click(short_url=short_url_key,
-                  referrer=referrer,
-                  referrer_name=referrer_name,
-                  referrer_medium=referrer_medium,
-                  ip_address=ip_address,
-                  location_country=location_country,
-                  location_region=location_region,
-                  location_city=location_city,
-                  location_lat_long=location_lat_long,
-                  user_agent_raw=user_agent_raw,
-                  user_agent_device=user_agent.device.family,
-                  user_agent_device_brand=user_agent.device.brand,
-                  user_agent_device_model=user_agent.device.model,
-                  user_agent_os=user_agent.os.family,
-                  user_agent_os_version=user_agent.os.version_string,
-                  user_agent_browser=user_agent.browser.family,
-                  user_agent_browser_version=user_agent.browser.version_string,
-                  custom_code=get_parameters.get('c'))
-    result = click.put()
-    deferred.defer(write_click_log_to_bq, result.id())
+    click = build_click(short_url_key, referrer, ip_address,
+                        location_country, location_region, location_city, location_lat_long,
+                        user_agent, get_parameters)
+    click.put()
+    increment_click_count(short_url_key.id())
+    defer_click_interval(click)
 
 
 def create_dataset():
-    client = get_bq_client()
+    client = click_log_sink.client
     if client.check_dataset(LOG_DATASET_NAME) is False:
         dataset = client.create_dataset(LOG_DATASET_NAME, friendly_name="jmpt.me url shortner click log",
                                         description="")
@@ -79,35 +164,14 @@ def create_dataset():
         return already_message
 
 
-def create_click_log_table(table_name):
+def create_click_log_table(table_name, client=None):
     """
     create table with YYYYMMDD suffix
     -> https://qiita.com/sinmetal/items/63207fe9d74547f986e0#_reference-2f7da1581b396526e6df
     """
-    schema = [
-        {'name': 'id', 'type': 'INTEGER', 'mode': 'required'},
-        {'name': 'short_url_id', 'type': 'STRING', 'mode': 'required'},
-        {'name': 'referrer', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'referrer_name', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'referrer_medium', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'ip_address', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'location_country', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'location_region', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'location_city', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'location_lat_long', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_raw', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_device', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_device_brand', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_device_model', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_os', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_os_version', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_browser', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'user_agent_browser_version', 'type': 'STRING', 'mode': 'nullable'},
-        {'name': 'custom_code', 'type': 'STRING', 'mode': 'nullable'},
-    ]
-    client = get_bq_client()
+    client = client or click_log_sink.client
     if client.check_table(LOG_DATASET_NAME, table_name) is False:
-        click_table = client.create_table(LOG_DATASET_NAME, table_name, schema)
+        click_table = client.create_table(LOG_DATASET_NAME, table_name, CLICK_LOG_SCHEMA)
         if click_table:
             success_message = 'table successfully created: {}'.format(table_name)
             logging.info(success_message)
@@ -118,13 +182,34 @@ def create_click_log_table(table_name):
         return already_message
 
 
-def write_click_log_to_bq(click_key_id):
-    click = Click.get_by_id(click_key_id)
-    table_name = 'click{}'.format(click.created_at.strftime('%Y%m%d'))
-    client = get_bq_client()
-    if client.check_table(LOG_DATASET_NAME, table_name) is False:
-        create_click_log_table(table_name)
-    rows = [{
+def provision_click_log_tables(days=CLICK_LOG_PROVISION_DAYS):  # type: (int) -> str
+    """
+    create the daily tables of the next days ahead of time, so that writers make no table metadata calls
+    """
+    client = click_log_sink.client
+    today = datetime.datetime.utcnow().date()
+    provisioned = []
+    for i in range(days):
+        table_name = click_log_table_name_for(today + datetime.timedelta(days=i))
+        if create_click_log_table(table_name, client):
+            known_click_log_tables.add(table_name)
+            memcache.set(KNOWN_TABLE_MEMCACHE_KEY.format(table_name), True, time=60 * 60 * 24 * (days + 1))
+            provisioned.append(table_name)
+    message = 'tables provisioned: {}'.format(', '.join(provisioned))
+    logging.info(message)
+    return message
+
+
+def click_log_table_name_for(date):
+    return 'click{}'.format(date.strftime('%Y%m%d'))
+
+
+def click_log_table_name(click):
+    return click_log_table_name_for(click.created_at)
+
+
+def click_log_row(click):
+    return {
         'id': click.key.id(),
         'short_url_id': click.short_url.id(),
         'referrer': click.referrer,
@@ -144,53 +229,229 @@ def write_click_log_to_bq(click_key_id):
         'user_agent_browser': click.user_agent_browser,
         'user_agent_browser_version': click.user_agent_browser_version,
         'custom_code': click.custom_code,
-    }]
-    client.push_rows(LOG_DATASET_NAME, table_name, rows, 'id')
+    }
+
+
+def ensure_click_log_table(client, table_name):
+    """
+    known tables are kept in process, tables created by provision_click_log_tables are known through memcache
+    """
+    if table_name in known_click_log_tables:
+        return
+    if memcache.get(KNOWN_TABLE_MEMCACHE_KEY.format(table_name)) or create_click_log_table(table_name, client):
+        known_click_log_tables.add(table_name)
+
+
+def defer_click_log_rows(table_name, rows):
+    deferred.defer(push_click_log_rows, table_name, rows, _countdown=60)
+
+
+def push_click_log_rows(table_name, rows):
+    """
+    retry of a batch the sink failed to push, raising makes the task queue retry it with backoff
+    """
+    if not click_log_sink.push(table_name, rows):
+        raise RuntimeError('bq insertion failed: {}, {} rows'.format(table_name, len(rows)))
+    logging.info('bq insertion done: {} rows'.format(len(rows)))
+
+
+click_log_sink = BigQuerySink(get_bq_client, LOG_DATASET_NAME,
+                              ensure_table=ensure_click_log_table, failure_handler=defer_click_log_rows)
+
+
+def defer_click_interval(click):  # type: (Click) -> None
+    timestamp = calendar.timegm(click.created_at.timetuple())
+    defer_per_interval('click-interval', LOG_DATASET_NAME, CLICK_INTERVAL_SECONDS, write_click_interval,
+                       int(timestamp / CLICK_INTERVAL_SECONDS), _timestamp=timestamp, _delay=CLICK_INTERVAL_DELAY)
+
+
+def write_click_interval(interval):  # type: (int) -> None
+    """
+    add the clicks created in an interval of CLICK_INTERVAL_SECONDS to the daily rollups and stream them to BigQuery
+    in batches of the sink, a retried task neither counts nor inserts a click twice:
+    rollups keep the intervals they counted and click ids are the insert ids
+    """
+    start = datetime.datetime.utcfromtimestamp(interval * CLICK_INTERVAL_SECONDS)
+    q = Click.query(Click.created_at >= start,
+                    Click.created_at < start + datetime.timedelta(seconds=CLICK_INTERVAL_SECONDS))
+
+    def add_to_sink(clicks):
+        for click in clicks:
+            click_log_sink.add(click_log_table_name(click), click_log_row(click))
+            yield click
+
+    deltas = aggregate_clicks(add_to_sink(q.iter(batch_size=BQ_BATCH_SIZE)))
+    apply_rollup_deltas(deltas, interval)
+    result = click_log_sink.flush()
+    logging.info('{} clicks of the interval rolled up, bq insertion done: {} rows'.format(
+        sum(d['count'] for d in deltas.values()), result))
+
+
+def write_click_log_to_bq(click_key_id):
+    # tasks deferred per click before write_click_interval still call this
+    click = Click.get_by_id(click_key_id)
+    click_log_sink.add(click_log_table_name(click), click_log_row(click))
+    click_log_sink.flush()
     logging.info('bq insertion done')
 
 
-def send_invitation(email, team_id, user_id, host):
-    user_key_name = "{}_{}".format(team_id, user_id)
-    user_entity = User.get_by_id(user_key_name)
-    team = Team.get_by_id(int(team_id))
-    key_name = uuid.uuid4().hex
-    Invitation(id=key_name, sent_to=email, team=team.key, created_by=user_entity.key).put()
-    invitation_link = "https://{}/page/invitation/{}".format(host, key_name)
-    config_file = os.path.join(os.path.dirname(__file__), 'config.json')
-    with open(config_file, 'r') as configFile:
-        config_dict = json.loads(configFile.read())
-    sg = sendgrid.SendGridAPIClient(apikey=config_dict['sendgrid_api_key'])
-    payload = {
-        "personalizations": [
-            {
-                "to": [
-                    {
-                        "email": email
-                    }
-                ],
-                "substitutions": {
-                    "%team_name%": team.team_name,
-                    "%invitation_link%": invitation_link
-                },
-                "subject": "jmpt.me invitation to {} team".format(team.team_name)
-            }
-        ],
-        "from": {
-            "email": config_dict['sendgrid_from_email'],
-            "name": "jmpt.me invitation"
-        },
-        "template_id": config_dict['sendgrid_template_id']
-    }
+def write_click_logs_to_bq(click_key_ids):
+    clicks = ndb.get_multi([ndb.Key(Click, i) for i in click_key_ids])
+    for click in clicks:
+        if click is not None:
+            click_log_sink.add(click_log_table_name(click), click_log_row(click))
+    result = click_log_sink.flush()
+    logging.info('bq insertion done: {} rows'.format(result))
+
+
+def backfill_redirects(cursor=None):
+    """
+    write Redirect for existing ShortURL entities, chained in batches by deferred tasks
+    """
+    q = ShortURL.query().order(ShortURL.key)
+    short_urls, next_cursor, more = q.fetch_page(BACKFILL_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor))
+    ndb.put_multi([Redirect.from_short_url(s) for s in short_urls])
+    logging.info('{} redirects backfilled'.format(len(short_urls)))
+    if more and next_cursor:
+        deferred.defer(backfill_redirects, next_cursor.urlsafe())
+
+
+def backfill_api_tokens(cursor=None):
+    """
+    re-key APITokens generated before hashing by the hash of the token, chained in batches by deferred tasks
+    """
+    q = APIToken.query().order(APIToken.key)
+    keys, next_cursor, more = q.fetch_page(BACKFILL_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor), keys_only=True)
+    legacy = [k.id() for k in keys if len(k.id()) == LEGACY_TOKEN_LENGTH]
+    for token in legacy:
+        migrate_legacy_token(token)
+    logging.info('{} legacy api tokens re-keyed'.format(len(legacy)))
+    if more and next_cursor:
+        deferred.defer(backfill_api_tokens, next_cursor.urlsafe())
+
+
+def backfill_long_url_index(cursor=None):
+    """
+    index existing ShortURL entities for dedup, entries written by shorten meanwhile are kept
+    """
+    q = ShortURL.query().order(ShortURL.key)
+    short_urls, next_cursor, more = q.fetch_page(BACKFILL_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor))
+    indexes = {}
+    for short_url in short_urls:
+        index = LongURLIndex.from_short_url(short_url)
+        indexes[index.key] = index
+    existing = ndb.get_multi(indexes.keys())
+    ndb.put_multi([i for i, found in zip(indexes.values(), existing) if found is None])
+    logging.info('{} short urls indexed'.format(len(short_urls)))
+    if more and next_cursor:
+        deferred.defer(backfill_long_url_index, next_cursor.urlsafe())
+
+
+def reindex_short_urls(cursor=None):
+    """
+    write all short urls to the search index, for short urls created before it and after index failures
+    """
+    q = ShortURL.query()
+    short_urls, next_cursor, more = q.fetch_page(SEARCH_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor))
+    index_short_urls(short_urls)
+    if more and next_cursor:
+        deferred.defer(reindex_short_urls, next_cursor.urlsafe())
+
+
+def rebuild_tag_summary(team_id):
+    """
+    count the tags of all short urls of the team, for teams with tags added before TagSummary
+    tag changes made while it runs may be lost, run it again in that case
+    """
+    counts = {}
+    for short_url in ShortURL.query(ShortURL.team == ndb.Key(Team, team_id)).iter(batch_size=BACKFILL_BATCH_SIZE):
+        for tag in set(short_url.tags):
+            counts[tag] = counts.get(tag, 0) + 1
+    TagSummary(id=team_id, counts=counts).put()
+
+
+def rebuild_tag_summaries():
+    for team_key in Team.query().iter(keys_only=True):
+        deferred.defer(rebuild_tag_summary, team_key.id())
+
+
+def defer_qr_export(export_id):  # type: (str) -> None
+    deferred.defer(build_qr_export, export_id, _retry_options=QR_EXPORT_RETRY_OPTIONS)
+
+
+def build_qr_export(export_id):  # type: (str) -> None
+    """
+    write the ZIP archive of a QRExport to the default Cloud Storage bucket, the archive is streamed to the bucket
+    and only QR_EXPORT_CHUNK_SIZE images are held in memory, a retried task writes the whole archive again
+    the export is marked failed when the last retry of QR_EXPORT_RETRY_OPTIONS fails
+    """
+    export = QRExport.get_by_id(export_id)
+    if export is None or export.status != 'pending':
+        return
+    object_name = QR_EXPORT_OBJECT_NAME.format(app_identity.get_default_gcs_bucket_name(), export_id)
     try:
-        response = sg.client.mail.send.post(request_body=payload)
-    except Exception as e:
-        logging.error(e.body)
-        return False
-    if response.status_code != 202:
-        logging.error(response.body)
-        return False
-    else:
-        return True
+        with cloudstorage.open(object_name, 'w', content_type='application/zip') as stream:
+            failed = write_qr_zip(stream, export.short_urls, export.size, export.error_level, export.image_format)
+    except Exception:
+        retry_count = int(os.environ.get('HTTP_X_APPENGINE_TASKRETRYCOUNT', 0))
+        if retry_count >= QR_EXPORT_RETRY_OPTIONS.task_retry_limit:
+            logging.exception('QR export failed after {} retries: {}'.format(retry_count, export_id))
+            export.status = 'failed'
+            export.put()
+            return
+        raise
+    export.object_name = object_name
+    export.failed = failed
+    export.status = 'done'
+    export.put()
+    logging.info('{} QR codes exported to {}'.format(len(export.short_urls) - len(failed), object_name))
+
+
+class InvitationDeliveryError(Exception):
+    pass
+
+
+def defer_invitations(invitation_ids, host):  # type: (list, str) -> None
+    for i in range(0, len(invitation_ids), INVITATION_BATCH_SIZE):
+        deferred.defer(deliver_invitations, invitation_ids[i:i + INVITATION_BATCH_SIZE], host,
+                       _retry_options=INVITATION_RETRY_OPTIONS)
+
+
+def deliver_invitations(invitation_ids, host):  # type: (list, str) -> int
+    """
+    send the invitation emails of Invitations written by the settings page in one request
+    raises InvitationDeliveryError on failure, so the task queue retries with exponential backoff
+    invitations already sent or accepted are skipped, retries never send them twice
+    """
+    invitations = [i for i in ndb.get_multi([ndb.Key(Invitation, i) for i in invitation_ids])
+                   if i is not None and i.accepted is not True and i.sent_at is None]
+    if not invitations:
+        return 0
+    team_keys = list(set(i.team for i in invitations))
+    teams = dict(zip(team_keys, ndb.get_multi(team_keys)))
+    personalizations = []
+    for invitation in invitations:
+        team = teams[invitation.team]
+        personalizations.append({
+            "to": [
+                {
+                    "email": invitation.sent_to
+                }
+            ],
+            "substitutions": {
+                "%team_name%": team.team_name,
+                "%invitation_link%": "https://{}/page/invitation/{}".format(host, invitation.key.id())
+            },
+            "subject": "jmpt.me invitation to {} team".format(team.team_name)
+        })
+    if not mail_transport.send(personalizations, "jmpt.me invitation"):
+        raise InvitationDeliveryError('{} invitations were not sent'.format(len(invitations)))
+    sent_at = datetime.datetime.now()
+    for invitation in invitations:
+        invitation.sent_at = sent_at
+    ndb.put_multi(invitations)
+    logging.info('{} invitations sent'.format(len(invitations)))
+    return len(invitations)
 
 
 def create_click_log_data(team):
@@ -209,28 +470,45 @@ def create_click_log_data(team):
         'Version/11.0 Mobile/15C153 Safari/604.1',
     ]
     for i in range(200):
-        user_agent_raw = random.choice(uas)
-        user_agent = parse(user_agent_raw)
-        referrer = random.choice(refferrers)
-        referrer_parsed = Referer(referrer)
-        click = Click(short_url=short_url.key,
-                      referrer=referrer,
-                      referrer_name=referrer_parsed.referer,
-                      referrer_medium=referrer_parsed.medium,
-                      ip_address='192.168.0.200',
-                      location_country='JP',
-                      location_region='13',
-                      location_city='shinjuku',
-                      location_lat_long='35.693840,139.703549',
-                      user_agent_raw=user_agent_raw,
-                      user_agent_device=user_agent.device.family,
-                      user_agent_device_brand=user_agent.device.brand,
-                      user_agent_device_model=user_agent.device.model,
-                      user_agent_os=user_agent.os.family,
-                      user_agent_os_version=user_agent.os.version_string,
-                      user_agent_browser=user_agent.browser.family,
-                      user_agent_browser_version=user_agent.browser.version_string,
-                      custom_code=None,
-                      created_at=datetime.datetime.now() + datetime.timedelta(days=random.randint(-90, 0)))
+        created_at = datetime.datetime.now() + datetime.timedelta(days=random.randint(-90, 0))
+        click = build_click(short_url.key, random.choice(refferrers), '192.168.0.200',
+                            'JP', '13', 'shinjuku', '35.693840,139.703549',
+                            random.choice(uas), {}, created_at=created_at)
         click.put()
     return True
+
+
+def enrich_short_urls(key_names):  # type: (list) -> None
+    """
+    fill in OGP data of pending short urls from the OGP cache, pages not cached are fetched concurrently
+    """
+    short_urls = [s for s in ndb.get_multi([ndb.Key(ShortURL, k) for k in key_names])
+                  if s is not None and s.enrichment_status == 'pending']
+    fetched = get_ogp_multi([s.long_url for s in short_urls])
+    enriched = [_apply_enrichment(s.key, ogp, warning) for s, (ogp, warning) in zip(short_urls, fetched)]
+    for team_id in set(s.team.id() for s in enriched if s is not None):
+        touch_short_urls(team_id)
+    # titles and descriptions are searchable
+    index_short_urls([s for s in enriched if s is not None])
+    logging.info('{} short urls enriched'.format(len(short_urls)))
+
+
+@ndb.transactional
+def _apply_enrichment(short_url_key, ogp, warning):
+    # the short url may have been edited or deleted while its page was fetched
+    short_url = short_url_key.get()
+    if short_url is None or short_url.enrichment_status != 'pending':
+        return
+    short_url.title = ogp.get('title', '')
+    short_url.description = ogp.get('description', '')
+    short_url.site_name = ogp.get('site_name', '')
+    short_url.image = ogp.get('image', '')
+    short_url.enrichment_status = 'done' if warning is None else 'failed'
+    short_url.enrichment_warning = warning
+    short_url.put()
+    return short_url
+
+
+def defer_enrichment(key_names):  # type: (list) -> None
+    for i in range(0, len(key_names), ENRICHMENT_BATCH_SIZE):
+        deferred.defer(enrich_short_urls, key_names[i:i + ENRICHMENT_BATCH_SIZE])
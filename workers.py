@@ -0,0 +1,66 @@
+import time
+import hashlib
+import logging
+import threading
+from Queue import Queue, Empty
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+from cache import LRUCache
+
+MAX_WORKERS = 10
+
+
+def map_concurrently(func, items, max_workers=MAX_WORKERS):  # type: (callable, list, int) -> list
+    """
+    apply func to items in at most max_workers threads of the current request, results keep the order of items
+    an exception raised by func is logged and its result is None
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                logging.exception('worker failed: {}'.format(item))
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# last interval each instance scheduled a task for, saves the task queue call for every further item
+scheduled_intervals = LRUCache('scheduled_intervals', max_size=10000)
+
+
+def defer_per_interval(prefix, key, interval, func, *args, **kwargs):  # type: (str, str, int, callable) -> None
+    """
+    defer func once per interval and key as a named task running after the interval ends,
+    work buffered meanwhile is done by that task, an interval whose task could not be added is covered by the next one
+    _timestamp picks the interval of that time instead of now, _delay runs the task that many seconds later
+    """
+    timestamp = kwargs.pop('_timestamp', None)
+    delay = kwargs.pop('_delay', 0)
+    bucket = int((timestamp if timestamp is not None else time.time()) / interval)
+    if scheduled_intervals.get((prefix, key)) == bucket:
+        return
+    # task names only allow [a-zA-Z0-9_-]
+    task_name = '{}-{}-{}'.format(prefix, hashlib.sha1(key.encode('utf-8')).hexdigest(), bucket)
+    try:
+        deferred.defer(func, *args, _name=task_name, _countdown=interval + delay, **kwargs)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    scheduled_intervals.set((prefix, key), bucket)